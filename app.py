@@ -1,12 +1,16 @@
 import streamlit as st
-import requests
-import numpy as np
 from PIL import Image
-from get_new_images import get_new_image
-from image_viz import summary, landscape_changes, image_colormap
-import streamlit as st
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from get_new_images import address_to_coord, S2MAPS_YEARS
+from comparison import result_key, submit_comparison, complete_result, rendered_comparison, record_comparison, compute_time_series, ResultsCache
+from image_viz import CLASSES
 import pandas as pd
-import numpy as np
+from prediction import get_backend
+from warmup import PRESETS, WarmupJob
+from metrics import metrics
+
+# st.cache_resource replaced st.experimental_singleton in streamlit 1.18
+cache_resource = st.cache_resource if hasattr(st, 'cache_resource') else st.experimental_singleton
 
 def update_text():
     st.session_state.text = st.session_state.selector
@@ -14,24 +18,58 @@ def update_text():
 def update_selector():
     st.session_state.selector = ''
 
+def locate(address):
+    '''
+    Geocodes the address, stops the script with an error message if it fails
+    '''
+    try:
+        return address_to_coord(address)
+    except Exception as e:
+        st.error(f"Could not locate '{address}' ({e})")
+        st.stop()
+
+@cache_resource(show_spinner=False)
+def load_assets():
+    '''
+    Loads the images and the css once per process
+    '''
+    #set images
+    logo = Image.open('wfa_logo.png')
+    icon = Image.open('wfa_icon.png')
+
+    # Labels size
+    lbls = Image.open('Labels2.png')
+    factor = 0.9
+    h = int(lbls.size[0]*factor)
+    w = int(lbls.size[1]*factor)
+    size = (h, w)
+    lbls = lbls.resize(size)
+
+    with open("style.css") as f:
+        css = f.read()
+
+    return logo, icon, lbls, css
+
+@cache_resource(show_spinner=False)
+def get_results_cache():
+    '''
+    Comparisons shared by all the sessions
+    '''
+    return ResultsCache()
 
-#set images
-logo = Image.open('wfa_logo.png')
-icon = Image.open('wfa_icon.png')
+@cache_resource(show_spinner=False)
+def start_warmup():
+    '''
+    Fills the results cache with the examples in the background, once per process
+    '''
+    return WarmupJob(get_results_cache(), get_backend()).start()
 
-# Labels size
-lbls = Image.open('Labels2.png')
-factor = 0.9
-h = int(lbls.size[0]*factor)
-w = int(lbls.size[1]*factor)
-size = (h, w)
-lbls = lbls.resize(size)
+logo, icon, lbls, css = load_assets()
 
 #set streamlit page config
 st.set_page_config(page_title="Watching From Above", page_icon=icon)
 
-with open("style.css") as f:
-    st.markdown('<style>{}</style>'.format(f.read()), unsafe_allow_html=True)
+st.markdown('<style>{}</style>'.format(css), unsafe_allow_html=True)
 
 #Remove Menu Button and Streamlit Icon
 hide_default_format = """
@@ -73,6 +111,14 @@ st.markdown(remove_w_s, unsafe_allow_html=True)
 
 st.image(logo, width=400)
 
+# Status of the warm-up of the examples
+warmup_status = start_warmup().status()
+if warmup_status['running']:
+    st.sidebar.progress(warmup_status['progress'])
+    st.sidebar.caption(f"Preparing examples {warmup_status['done']}/{warmup_status['total']}")
+elif warmup_status['finished_at'] is not None:
+    st.sidebar.caption(f"Examples ready ({warmup_status['errors']} errors)")
+
 st.subheader(':satellite: Discover landscape evolution with Sentinel-2 satellite (EuroSAT) :satellite:')
 
 ##################################################
@@ -88,16 +134,7 @@ with cola2:
 with cola3:
     #address = st.text_input('Adress or GPS coordinates','-20.859100, -61.143501')
     st.markdown('Interesting examples :stuck_out_tongue_winking_eye::', unsafe_allow_html=True)
-    x = st.selectbox('Options', ('',
-                                 '-20.859100, -61.143501',  # Deforestation Paraguay 1
-                                 '70, -22.32',              # Greenland melting
-                                 'Sao paulo',
-                                 '-20.596496, -60.505891',  # Deforestation Paraguay 2
-                                 '-21.607402, -60.635624',  # Deforestation Paraguay 3
-                                 '-22.183099, -61.431191',  # Deforestation Paraguay 4
-                                 '29.9298757, 31.6514432',  # New Administrative Capital, Wedian - Egypt
-                                 '-24.319728, -50.447382'  # Pin forest in Brazil
-                                 ),index=0, label_visibility="collapsed", key = 'selector', on_change= update_text)
+    x = st.selectbox('Options', ('',) + tuple(PRESETS),index=0, label_visibility="collapsed", key = 'selector', on_change= update_text)
 
 
 coly1, coly2, coly3, coly4 = st.columns([2, 2, 2, 2])
@@ -117,83 +154,88 @@ if year_2 == '2017 (Europe only)':
 colb1, colb2, colb3 = st.columns([2, 4, 2])
 with colb2:
     submitted = st.button('Landscape evolution')
+    time_series = st.checkbox('Several years (time series)')
+    if time_series:
+        # the 2017 layer only covers Europe, elsewhere it is blank and must not be classified
+        series_years = st.multiselect('Years', S2MAPS_YEARS, default=[year for year in S2MAPS_YEARS if year != '2017'],
+                                      format_func=lambda year: '2017 (Europe only)' if year == '2017' else year)
 
-params = dict(
-    address = address,
-    year_1 = year_1,
-    year_2 = year_2)
-
-wfa_api_url = 'https://wfa04-tqv5zy4gla-ew.a.run.app/watchingfromabove/prediction'
+backend = get_backend()
 
 with st.spinner('calling API'):
-    if submitted:
+    if submitted and not time_series:
         ##################################################
-        #          API Call                              #
+        #          Address resolved only once            #
         ##################################################
-        response = requests.get(wfa_api_url, params=params)
-        results = response.json()
-
-        # Extract predictions for each image
-        cat_year_1_np = np.array(results['year_1']) # year_1 to be confirmed
-        cat_year_2_np = np.array(results['year_2']) # year_2 to be confirmed
-
-        # using summary function to compare results
-        changes, sry = summary(cat_year_1_np, cat_year_2_np)
-
+        lat, lon = locate(address)
 
         ##################################################
-        #          Getting images for display            #
+        #  Predictions and images fetched in parallel    #
         ##################################################
-        # Get the correspondent images
-        image_year_1 = get_new_image(address, year_1)
-        image_year_2 = get_new_image(address, year_2)
-
-
-        ########################################################
-        #          FIRST TABLE - Plot original images          #
-        ########################################################
-        st.markdown("***")
-        colesp, col10, col11, col12, col13, col14, col15 = st.columns([0.4, 0.2, 0.85, 0.85, 0.85, 0.4, 0.2])
-        with col10:
-            st.subheader(f"{year_1}")
-
-        with col11:
-            st.image(image_year_1)
-
-        with col12:
-            img_changes_1 = landscape_changes(image_year_1, changes)
-            st.image(img_changes_1)
-
-
-        with col13:
-            img_colormap_1 = image_colormap(cat_year_1_np)
-            st.image(img_colormap_1)
-
-
-        with col14:
-            st.image(lbls)
-
-        #######################################################
-        #          SECOND TABLE - Plot comparision            #
-        #######################################################
-        colesp, col20, col21, col22, col23, col24, col25 = st.columns([0.4, 0.2, 0.85, 0.85, 0.85, 0.4, 0.2])
-        with col20:
-            st.subheader(f"{year_2}")
-
-        with col21:
-            st.image(image_year_2)
-
-        with col22:
-            img_changes_2 = landscape_changes(image_year_2, changes)
-            st.image(img_changes_2)
-
-
-        with col23:
-            img_colormap_2 = image_colormap(cat_year_2_np)
-            st.image(img_colormap_2)
-
-        with col24:
-            pass
+        key = result_key(lat, lon, year_1, year_2)
+        result = get_results_cache().get(key)
+        cached = result is not None
+        if not cached:
+            executor = ThreadPoolExecutor(max_workers=3)
+            futures = submit_comparison(executor, lat, lon, year_1, year_2, backend)
+            result = {}
+
+
+        if cached:
+            ########################################################
+            #   Both tables rendered once, sent as a single image  #
+            ########################################################
+            if 'rendered' not in result:
+                rendered_comparison(result)
+                # stored again so that the cache counts the rendered bytes
+                get_results_cache().set(key, result)
+            st.markdown("***")
+            st.markdown(f"**{year_1}** (top) and **{year_2}** (bottom)")
+            st.image(result['rendered'])
+        else:
+            ########################################################
+            #          FIRST TABLE - Plot original images          #
+            ########################################################
+            st.markdown("***")
+            colesp, col10, col11, col12, col13, col14, col15 = st.columns([0.4, 0.2, 0.85, 0.85, 0.85, 0.4, 0.2])
+            with col10:
+                st.subheader(f"{year_1}")
+
+            with col14:
+                st.image(lbls)
+
+            #######################################################
+            #          SECOND TABLE - Plot comparision            #
+            #######################################################
+            colesp, col20, col21, col22, col23, col24, col25 = st.columns([0.4, 0.2, 0.85, 0.85, 0.85, 0.4, 0.2])
+            with col20:
+                st.subheader(f"{year_2}")
+
+            # Each panel is filled as soon as its inputs arrive
+            panels = {
+                'image_year_1': col11.empty(),
+                'changes_year_1': col12.empty(),
+                'colormap_year_1': col13.empty(),
+                'image_year_2': col21.empty(),
+                'changes_year_2': col22.empty(),
+                'colormap_year_2': col23.empty()}
+
+            for future in as_completed(futures):
+                name = futures[future]
+                try:
+                    result[name] = future.result()
+                except Exception as e:
+                    executor.shutdown(wait=False)
+                    st.error(f"The satellite images or the predictions are unavailable, please try again later ({e})")
+                    st.stop()
+
+                for key_added in [name] + complete_result(result):
+                    if key_added in panels:
+                        panels[key_added].image(result[key_added])
+
+            executor.shutdown()
+            get_results_cache().set(key, result)
+            record_comparison(lat, lon, year_1, year_2, result, backend)
 
 
         #######################################################
@@ -203,8 +245,8 @@ with st.spinner('calling API'):
         colt1, colt2, colt3 = st.columns([1, 1, 1])
         with colt2:
             columns_names = ["Categories", f"{year_1}", f"{year_2}", "Difference"]
-            sry.columns = columns_names
-            sry.set_index("Categories", inplace=True)
+            # the cached summary is shared, it must not be modified
+            sry = result['summary'].set_axis(columns_names, axis=1).set_index("Categories")
 
             ########## dataframe style
             th_props = [
@@ -235,3 +277,65 @@ with st.spinner('calling API'):
             #st.dataframe(data=sry, width=700)
 
         st.balloons()
+
+#######################################################
+#                    TIME SERIES                      #
+#######################################################
+with st.spinner('calling API'):
+    if submitted and time_series:
+        lat, lon = locate(address)
+
+        if len(series_years) < 2:
+            st.error("Please select at least two years")
+            st.stop()
+        # in chronological order, whatever the order of selection
+        series_years = sorted(series_years)
+
+        # not the key of a comparison of the same two years
+        key = result_key(lat, lon, 'series', *series_years)
+        series = get_results_cache().get(key)
+        if series is None:
+            try:
+                series = compute_time_series(lat, lon, series_years, backend)
+            except Exception as e:
+                st.error(f"The satellite images or the predictions are unavailable, please try again later ({e})")
+                st.stop()
+            get_results_cache().set(key, series)
+
+        st.markdown("***")
+        for i, year in enumerate(series['years']):
+            colesp, col10, col11, col12, col13, col14 = st.columns([0.4, 0.2, 0.85, 0.85, 0.4, 0.2])
+            with col10:
+                st.subheader(f"{year}")
+            with col11:
+                st.image(series['images'][i])
+            with col12:
+                st.image(series['colormaps'][i])
+            with col13:
+                if i == 0:
+                    st.image(lbls)
+
+        st.markdown(" ")
+        colt1, colt2, colt3 = st.columns([1, 2, 1])
+        with colt2:
+            # share of each class every year, only the classes seen at least once
+            present = series['trends'].sum(axis=0) > 0
+            trends = pd.DataFrame(series['trends'][:, present] * 100,
+                                  index=series['years'],
+                                  columns=CLASSES[present])
+            st.line_chart(trends)
+
+            changed = series['trajectories']['n_changes'] > 0
+            st.markdown(f"Quadrands that changed at least once: {changed.mean():.0%}")
+
+        st.balloons()
+
+#######################################################
+#                    DEBUG PANEL                      #
+#######################################################
+if st.sidebar.checkbox('Debug metrics'):
+    stages = pd.DataFrame(metrics.snapshot()).T
+    if len(stages) > 0:
+        stages['mean_seconds'] = stages['seconds'] / stages['count']
+    st.sidebar.dataframe(stages)
+    st.sidebar.code(metrics.to_prometheus())
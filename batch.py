@@ -0,0 +1,256 @@
+import os
+import json
+import pickle
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import get_context
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from geocoding import geocode_many
+from get_new_images import get_image
+from large_area import area_bounding_box, pixels_per_degree, get_large_area, classify_large_area
+from image_viz import summary, CLASSES
+from prediction import get_backend
+from storage import ResultArchive, site_id
+
+#################################################
+#                 BATCH PROCESSING              #
+#################################################
+
+# Number of locations processed at the same time
+MAX_WORKERS = 4
+# Processes analyzing the locations when the backend classifies the images itself (CPU bound),
+# one per core by default. The remote API is I/O bound and keeps the MAX_WORKERS threads
+BATCH_PROCESSES = int(os.environ.get('WFA_BATCH_PROCESSES', os.cpu_count() or 1))
+DEFAULT_YEAR_1 = '2018'
+DEFAULT_YEAR_2 = '2020'
+
+def read_locations(path:str) -> pd.DataFrame:
+    '''
+    Reads a CSV or JSONL file with one location per line. Each location has either an
+    'address' or 'lat' and 'lon' columns, 'year_1' and 'year_2' are optional
+    '''
+    if path.endswith('.jsonl') or path.endswith('.json'):
+        locations = pd.read_json(path, lines=True, dtype=False)
+    else:
+        locations = pd.read_csv(path, dtype=str)
+
+    if 'address' not in locations.columns:
+        locations['address'] = None
+    for column, default in (('year_1', DEFAULT_YEAR_1), ('year_2', DEFAULT_YEAR_2)):
+        if column not in locations.columns:
+            locations[column] = default
+        locations[column] = locations[column].fillna(default).astype(str)
+    if 'id' not in locations.columns:
+        locations['id'] = range(len(locations))
+    return locations
+
+def resolve_locations(locations:pd.DataFrame) -> pd.DataFrame:
+    '''
+    Adds the lat and lon columns, addresses are geocoded together (see geocoding.geocode_many).
+    The 'geocoding_error' column tells why a location could not be resolved
+    '''
+    locations = locations.copy()
+    if 'lat' not in locations.columns:
+        locations['lat'] = np.nan
+        locations['lon'] = np.nan
+    locations['lat'] = pd.to_numeric(locations['lat'])
+    locations['lon'] = pd.to_numeric(locations['lon'])
+
+    missing = locations['lat'].isna() & locations['address'].notna()
+    errors = []
+    coords = geocode_many(locations.loc[missing, 'address'].tolist(), errors)
+    locations.loc[missing, 'lat'] = [c[0] if c is not None else np.nan for c in coords]
+    locations.loc[missing, 'lon'] = [c[1] if c is not None else np.nan for c in coords]
+    locations['geocoding_error'] = None
+    locations.loc[missing, 'geocoding_error'] = errors
+    return locations
+
+def analyze_location(lat:float, lon:float, year_1:str, year_2:str, backend) -> dict:
+    '''
+    Classifies both years of a location and compares them
+    '''
+    if backend.uses_images:
+        image_year_1 = get_image(lat, lon, year_1)
+        image_year_2 = get_image(lat, lon, year_2)
+        cat_year_1_np, cat_year_2_np = backend.predict(lat, lon, year_1, year_2, image_year_1, image_year_2)
+    else:
+        cat_year_1_np, cat_year_2_np = backend.predict(lat, lon, year_1, year_2)
+
+    changes, _, matrix = summary(cat_year_1_np, cat_year_2_np, transitions=True)
+    return dict(classes_year_1=cat_year_1_np, classes_year_2=cat_year_2_np, changes=changes, transitions=matrix)
+
+_worker_backend = None
+
+def _init_worker(backend):
+    global _worker_backend
+    _worker_backend = backend
+
+def analyze_in_worker(lat:float, lon:float, year_1:str, year_2:str) -> dict:
+    '''
+    analyze_location in a worker process, with the backend received when the worker started
+    '''
+    return analyze_location(lat, lon, year_1, year_2, _worker_backend)
+
+def can_use_processes(backend, processes:int) -> bool:
+    '''
+    True if the locations are worth analyzing in processes: CPU bound backend that can be pickled
+    '''
+    if processes <= 1 or not backend.uses_images:
+        return False
+    try:
+        pickle.dumps(backend)
+    except Exception:
+        return False
+    return True
+
+def run_batch(locations:pd.DataFrame, backend, max_workers:int=MAX_WORKERS, progress=None, archive:ResultArchive=None,
+              processes:int=BATCH_PROCESSES) -> tuple:
+    '''
+    Analyzes every location with at most max_workers locations in flight, or spread over
+    'processes' processes when the backend classifies the images itself (see can_use_processes).
+    Returns the (summaries, changes) DataFrames, errors are reported in the 'error' column of changes.
+    The class grids and changes masks are also stored in the archive if given
+    '''
+    locations = resolve_locations(locations)
+    summaries = []
+    changes = []
+
+    use_processes = can_use_processes(backend, processes)
+    if use_processes:
+        # spawn: forking a process running threads (http pools) is unsafe
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=get_context('spawn'),
+                                       initializer=_init_worker, initargs=(backend,))
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    with executor:
+        futures = {}
+        for row in locations.itertuples(index=False):
+            if np.isnan(row.lat):
+                changes.append(dict(id=row.id, address=row.address, error=row.geocoding_error or 'address not found'))
+                continue
+            if use_processes:
+                future = executor.submit(analyze_in_worker, row.lat, row.lon, row.year_1, row.year_2)
+            else:
+                future = executor.submit(analyze_location, row.lat, row.lon, row.year_1, row.year_2, backend)
+            futures[future] = row
+
+        for done, future in enumerate(as_completed(futures), start=1):
+            row = futures[future]
+            site = dict(id=row.id, address=row.address, lat=row.lat, lon=row.lon, year_1=row.year_1, year_2=row.year_2)
+            try:
+                result = future.result()
+            except Exception as e:
+                changes.append(dict(site, error=repr(e)))
+            else:
+                matrix = result['transitions']
+                total = matrix.sum()
+                for cat_ID in np.flatnonzero(matrix.sum(axis=0) + matrix.sum(axis=1)):
+                    summaries.append(dict(site,
+                                          cat_ID=int(cat_ID),
+                                          cat_name=CLASSES[cat_ID],
+                                          share_year_1=matrix[cat_ID].sum() / total,
+                                          share_year_2=matrix[:, cat_ID].sum() / total))
+
+                if archive is not None:
+                    site_key = site_id(row.lat, row.lon)
+                    archive.write_classes(site_key, row.year_1, result['classes_year_1'])
+                    archive.write_classes(site_key, row.year_2, result['classes_year_2'])
+                    archive.write_changes(site_key, row.year_1, row.year_2, result['changes'])
+
+                rows, cols = result['changes'].shape
+                changes.append(dict(site,
+                                    rows=rows,
+                                    cols=cols,
+                                    changed_share=result['changes'].mean(),
+                                    changes=result['changes'].astype('uint8').ravel().tolist(),
+                                    classes_year_1=np.asarray(result['classes_year_1'], dtype='uint8').ravel().tolist(),
+                                    classes_year_2=np.asarray(result['classes_year_2'], dtype='uint8').ravel().tolist(),
+                                    error=None))
+            if progress is not None:
+                progress(done, len(futures))
+
+    return pd.DataFrame(summaries), pd.DataFrame(changes)
+
+def area_id(bbox) -> str:
+    '''
+    Identifier of a large area in the archive, from its two corners
+    '''
+    return f"{site_id(bbox.lat_min, bbox.lon_min)}:{site_id(bbox.lat_max, bbox.lon_max)}"
+
+def run_area(bbox, years:list, backend, mosaic_dir:str=None, archive:ResultArchive=None) -> pd.DataFrame:
+    '''
+    Classifies every 64x64 tile of a large area (see large_area) for each year.
+    The mosaics are memory mapped .npy files in mosaic_dir if given, instead of living in memory.
+    Returns one row per tile and year with the center of the tile and its class.
+    The class grids are also stored in the archive if given
+    '''
+    if not backend.uses_images:
+        raise ValueError('Large areas need a backend classifying the images (local or stub)')
+
+    per_lat, per_lon = pixels_per_degree(bbox)
+    tiles = []
+    for year in years:
+        path = os.path.join(mosaic_dir, f"mosaic_{year}.npy") if mosaic_dir else None
+        mosaic = get_large_area(bbox, year, path=path)
+        classes = classify_large_area(mosaic, backend.classify)
+        if archive is not None:
+            archive.write_classes(area_id(bbox), year, classes)
+
+        rows, cols = np.indices(classes.shape)
+        tiles.append(pd.DataFrame(dict(year=str(year),
+                                       row=rows.ravel(),
+                                       col=cols.ravel(),
+                                       lat=bbox.lat_max - (rows.ravel() + 0.5) * 64 / per_lat,
+                                       lon=bbox.lon_min + (cols.ravel() + 0.5) * 64 / per_lon,
+                                       cat_ID=classes.ravel(),
+                                       cat_name=CLASSES[classes.ravel()])))
+    return pd.concat(tiles, ignore_index=True)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compares the landscape of many locations between two years')
+    parser.add_argument('input', nargs='?', help='CSV or JSONL file with address or lat/lon, and optionally year_1/year_2')
+    parser.add_argument('output', help='folder receiving summaries.parquet and changes.parquet, or area.parquet and the mosaic_<year>.npy images with --bbox')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS, help='locations processed at the same time')
+    parser.add_argument('--archive', help='folder of a ResultArchive receiving the class grids and changes masks')
+    parser.add_argument('--processes', type=int, default=BATCH_PROCESSES,
+                        help='processes analyzing the locations with a local or stub backend')
+    parser.add_argument('--bbox', help='lat_min,lon_min,lat_max,lon_max of a large area classified tile by tile, '
+                                       'instead of the locations of input (local or stub backend), '
+                                       'e.g. --bbox=-20.9,-61.2,-20.8,-61.1')
+    parser.add_argument('--year', nargs='+', default=[DEFAULT_YEAR_2], help='years of the large area')
+    args = parser.parse_args(argv)
+
+    if args.bbox:
+        try:
+            bbox = area_bounding_box(*[float(value) for value in args.bbox.split(',')])
+        except (TypeError, ValueError, AssertionError):
+            parser.error('--bbox must be lat_min,lon_min,lat_max,lon_max')
+        backend = get_backend()
+        if not backend.uses_images:
+            parser.error('--bbox needs WFA_BACKEND=local or stub')
+        os.makedirs(args.output, exist_ok=True)
+        archive = ResultArchive(args.archive) if args.archive else None
+        tiles = run_area(bbox, args.year, backend, mosaic_dir=args.output, archive=archive)
+        tiles.to_parquet(os.path.join(args.output, 'area.parquet'), index=False)
+        print(json.dumps(dict(tiles=len(tiles), years=args.year)))
+        return
+    if args.input is None:
+        parser.error('input is required without --bbox')
+
+    locations = read_locations(args.input)
+    archive = ResultArchive(args.archive) if args.archive else None
+    summaries, changes = run_batch(locations, get_backend(), args.workers,
+                                   progress=lambda done, total: print(f"{done}/{total}", flush=True),
+                                   archive=archive,
+                                   processes=args.processes)
+
+    os.makedirs(args.output, exist_ok=True)
+    summaries.to_parquet(os.path.join(args.output, 'summaries.parquet'), index=False)
+    changes.to_parquet(os.path.join(args.output, 'changes.parquet'), index=False)
+    errors = changes['error'].notna().sum() if 'error' in changes.columns else 0
+    print(json.dumps(dict(locations=len(locations), errors=int(errors))))
+
+if __name__ == '__main__':
+    main()
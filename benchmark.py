@@ -0,0 +1,288 @@
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import subprocess
+import argparse
+import platform
+import tempfile
+import threading
+import numpy as np
+from PIL import Image
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+#################################################
+#             FAKE UPSTREAM SERVERS             #
+#################################################
+
+CAPABILITIES = '''<?xml version="1.0" encoding="UTF-8"?>
+<WMT_MS_Capabilities version="1.1.1">
+<Service><Name>OGC:WMS</Name><Title>Fake EOX</Title></Service>
+<Capability>
+<Request>
+<GetCapabilities><Format>application/vnd.ogc.wms_xml</Format>
+<DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="{url}/wms?"/></Get></HTTP></DCPType>
+</GetCapabilities>
+<GetMap><Format>image/jpeg</Format>
+<DCPType><HTTP><Get><OnlineResource xmlns:xlink="http://www.w3.org/1999/xlink" xlink:href="{url}/wms?"/></Get></HTTP></DCPType>
+</GetMap>
+</Request>
+<Exception><Format>application/vnd.ogc.se_xml</Format></Exception>
+<Layer><Title>Fake EOX</Title><SRS>EPSG:4326</SRS>
+{layers}
+</Layer>
+</Capability>
+</WMT_MS_Capabilities>
+'''
+LAYER = '''<Layer><Name>s2cloudless-{year}</Name><Title>s2cloudless {year}</Title><SRS>EPSG:4326</SRS>
+<LatLonBoundingBox minx="-180" miny="-90" maxx="180" maxy="90"/></Layer>'''
+
+def synthetic_jpeg(width:int, height:int, seed:int=0) -> bytes:
+    '''
+    JPEG with random 64x64 blocks of color, roughly as compressible as satellite images
+    '''
+    rng = np.random.default_rng(seed)
+    blocks = rng.integers(0, 255, ((height + 63) // 64, (width + 63) // 64, 3), dtype='uint8')
+    pixels = np.repeat(np.repeat(blocks, 64, axis=0), 64, axis=1)[:height, :width]
+    noise = rng.integers(0, 32, pixels.shape, dtype='uint8')
+    output = io.BytesIO()
+    Image.fromarray(pixels + noise).save(output, format='JPEG', quality=85)
+    return output.getvalue()
+
+class FakeUpstream(object):
+    """
+    Local stand-in for the EOX WMS, the Google tiles, Nominatim and the prediction API.
+    Every request waits 'latency' seconds before being answered
+    """
+    def __init__(self, latency:float=0.0):
+        self.latency = latency
+        self.requests = 0
+        upstream = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                upstream.requests += 1
+                time.sleep(upstream.latency)
+                url = urlparse(self.path)
+                query = {key.lower(): values[0] for key, values in parse_qs(url.query).items()}
+                if url.path == '/wms' and query.get('request', '').lower() == 'getcapabilities':
+                    layers = '\n'.join(LAYER.format(year=year) for year in range(2017, 2021))
+                    self.reply(CAPABILITIES.format(url=upstream.url, layers=layers).encode(), 'application/vnd.ogc.wms_xml')
+                elif url.path == '/wms':
+                    self.reply(synthetic_jpeg(int(query['width']), int(query['height'])), 'image/jpeg')
+                elif url.path == '/kh':
+                    seed = int(query['x']) * 7919 + int(query['y'])
+                    self.reply(synthetic_jpeg(256, 256, seed), 'image/jpeg')
+                elif url.path == '/search':
+                    self.reply(json.dumps([{'lat': '-23.55', 'lon': '-46.63'}]).encode(), 'application/json')
+                elif url.path == '/prediction':
+                    rng = np.random.default_rng(0)
+                    grids = {year: rng.integers(0, 10, (10, 10)).tolist() for year in ('year_1', 'year_2')}
+                    self.reply(json.dumps(grids).encode(), 'application/json')
+                else:
+                    self.send_error(404)
+
+            def reply(self, content:bytes, content_type:str):
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
+        self.server.server_close()
+
+def use_upstream(url:str, cache_dir:str):
+    '''
+    Points every module to the fake upstream and to an empty disk cache, index and
+    capabilities file in cache_dir
+    '''
+    import cache
+    import geocoding
+    import get_new_images
+    import spatial_index
+    get_new_images.WMS_URL = f"{url}/wms"
+    get_new_images.TILE_URL = f"{url}/kh"
+    get_new_images.CAPABILITIES_FILE = os.path.join(cache_dir, 'wms_capabilities.xml')
+    get_new_images._wms = None
+    get_new_images._wms_attempted_at = 0.0
+    geocoding.NOMINATIM_URL = f"{url}/search"
+    geocoding._memory.clear()
+    cache._cache = cache.DiskCache(os.path.join(cache_dir, 'cache'))
+    spatial_index._index = spatial_index.SpatialIndex(os.path.join(cache_dir, 'spatial_index'))
+
+#################################################
+#                   BENCHMARKS                  #
+#################################################
+
+def measure(func, repeat:int=5) -> dict:
+    '''
+    Runs func 'repeat' times and returns the best and mean durations in seconds
+    '''
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - start)
+    return dict(best=min(durations), mean=sum(durations) / len(durations))
+
+def bench_functions(grid_sizes:list, repeat:int) -> dict:
+    '''
+    Throughput of the CPU bound functions on synthetic data, for grids of n x n tiles
+    '''
+    from get_new_images import split_tiles, stitch_tiles
+    from image_viz import summary, landscape_changes, image_colormap
+
+    results = {}
+    rng = np.random.default_rng(0)
+    for n in grid_sizes:
+        image = Image.fromarray(rng.integers(0, 255, (n * 64, n * 64, 3), dtype='uint8'))
+        classes_1 = rng.integers(0, 10, (n, n))
+        classes_2 = rng.integers(0, 10, (n, n))
+        changes, _ = summary(classes_1, classes_2)
+        tiles = {f"{x}_{y}": image.crop((x*64, y*64, x*64+64, y*64+64)) for x in range(n) for y in range(n)}
+
+        results[f"split_tiles[{n}]"] = measure(lambda: split_tiles(image), repeat)
+        results[f"summary[{n}]"] = measure(lambda: summary(classes_1, classes_2), repeat)
+        results[f"landscape_changes[{n}]"] = measure(lambda: landscape_changes(image, changes), repeat)
+        results[f"image_colormap[{n}]"] = measure(lambda: image_colormap(classes_1), repeat)
+        results[f"stitch_tiles[{n}]"] = measure(lambda: stitch_tiles(tiles, 0, 0, n, 64), repeat)
+    return results
+
+# Modules imported by the serving path, and the heavy dependencies they must not load at import
+SERVING_MODULES = ['get_new_images', 'image_viz', 'comparison', 'prediction', 'server']
+LAZY_DEPENDENCIES = ['matplotlib', 'owslib']
+
+def bench_imports(modules:list, repeat:int) -> dict:
+    '''
+    Import time of each module in a fresh interpreter, minus the start of the interpreter itself
+    '''
+    def run(code):
+        return lambda: subprocess.run([sys.executable, '-c', code], check=True)
+
+    baseline = measure(run('pass'), repeat)['best']
+    results = {}
+    for module in modules:
+        timing = measure(run(f"import {module}"), repeat)
+        results[f"import[{module}]"] = {key: max(value - baseline, 0.0) for key, value in timing.items()}
+    return results
+
+def eager_imports(modules:list, dependencies:list) -> list:
+    '''
+    Returns the dependencies loaded by importing the modules, which should be imported lazily
+    '''
+    code = (f"import sys\nimport {', '.join(modules)}\n"
+            f"print(' '.join(name for name in {dependencies!r} if name in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True)
+    return output.stdout.split()
+
+def bench_pipeline(latency:float, repeat:int) -> dict:
+    '''
+    End to end timings against the fake upstream: cold (empty caches) and warm
+    '''
+    from get_new_images import get_new_image
+    from comparison import compute_comparison
+    from prediction import RemoteBackend
+
+    results = {}
+    with FakeUpstream(latency) as upstream:
+        backend = RemoteBackend(f"{upstream.url}/prediction")
+        cache_dir = tempfile.mkdtemp(prefix='wfa_bench_')
+        try:
+            def cold(func):
+                def run():
+                    shutil.rmtree(cache_dir, ignore_errors=True)
+                    use_upstream(upstream.url, cache_dir)
+                    func()
+                return run
+
+            s2maps = lambda: get_new_image('-20.8591, -61.1435', '2018')
+            google = lambda: get_new_image('-20.8591, -61.1435', 'Google')
+            comparison = lambda: compute_comparison(-20.8591, -61.1435, '2018', '2020', backend)
+            geocoding = lambda: get_new_image('Sao paulo', '2018')
+
+            results['get_new_image[s2maps,cold]'] = measure(cold(s2maps), repeat)
+            results['get_new_image[s2maps,warm]'] = measure(s2maps, repeat)
+            results['get_new_image[google,cold]'] = measure(cold(google), repeat)
+            results['get_new_image[google,warm]'] = measure(google, repeat)
+            results['get_new_image[address,cold]'] = measure(cold(geocoding), repeat)
+            results['compute_comparison[cold]'] = measure(cold(comparison), repeat)
+            results['compute_comparison[warm]'] = measure(comparison, repeat)
+        finally:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+    return results
+
+def compare_runs(previous:dict, current:dict, threshold:float) -> list:
+    '''
+    Returns the benchmarks whose best time got slower than 'threshold' times the previous run
+    '''
+    regressions = []
+    for name, timing in current['results'].items():
+        before = previous['results'].get(name)
+        if before is None:
+            continue
+        ratio = timing['best'] / before['best'] if before['best'] > 0 else 1.0
+        print(f"{name:40s} {before['best']*1000:10.2f} ms -> {timing['best']*1000:10.2f} ms  x{ratio:.2f}")
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Offline benchmarks of the WFA pipeline')
+    parser.add_argument('--output', default='bench_results.jsonl', help='file receiving one JSON line per run')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds added to every fake upstream request')
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=[10, 20, 40])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    args = parser.parse_args(argv)
+
+    run = dict(time=time.time(),
+               python=platform.python_version(),
+               machine=platform.machine(),
+               latency=args.latency,
+               results={})
+    run['results'].update(bench_imports(SERVING_MODULES, args.repeat))
+    run['results'].update(bench_functions(args.grid_sizes, args.repeat))
+    run['results'].update(bench_pipeline(args.latency, args.repeat))
+
+    eager = eager_imports(SERVING_MODULES, LAZY_DEPENDENCIES)
+    if eager:
+        print(f"Imported at startup: {', '.join(eager)}")
+        return 1
+
+    previous = None
+    if os.path.exists(args.output):
+        with open(args.output) as f:
+            lines = [line for line in f if line.strip()]
+        if lines:
+            previous = json.loads(lines[-1])
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run) + '\n')
+
+    if previous is None:
+        for name, timing in run['results'].items():
+            print(f"{name:40s} {timing['best']*1000:10.2f} ms")
+        return 0
+
+    regressions = compare_runs(previous, run, args.threshold)
+    if regressions:
+        print(f"Regressions: {', '.join(regressions)}")
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
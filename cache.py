@@ -0,0 +1,169 @@
+import os
+import time
+import hashlib
+import threading
+
+#################################################
+#                  DISK CACHE                   #
+#################################################
+
+# Folder, maximum size (bytes) and time to live (seconds) of the default cache
+CACHE_DIR = os.environ.get('WFA_CACHE_DIR', '.wfa_cache')
+CACHE_MAX_BYTES = int(os.environ.get('WFA_CACHE_MAX_BYTES', 500 * 1024 * 1024))
+CACHE_TTL = int(os.environ.get('WFA_CACHE_TTL', 30 * 24 * 3600))
+
+class DiskCache(object):
+    """
+    Content addressed cache storing raw bytes (tiles, WMS images...) on disk.
+
+    Every entry is a file named after the sha256 of its key. The modification time
+    of the file is the moment it was written (used for the TTL) and the access time
+    is updated on every hit (used for the LRU eviction once 'max_bytes' is exceeded).
+    """
+    def __init__(self, directory:str=CACHE_DIR, max_bytes:int=CACHE_MAX_BYTES, ttl:float=CACHE_TTL):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._files())
+
+    @staticmethod
+    def key(*parts) -> str:
+        '''
+        Builds the key of an entry from its parts, e.g. key('tile', x, y, z)
+        '''
+        text = '|'.join(str(part) for part in parts)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def _path(self, key:str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _files(self):
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith('.tmp'):
+                    yield os.path.join(root, name)
+
+    def get(self, key:str, stale:bool=False):
+        '''
+        Returns the bytes stored for the key, or None if missing or expired.
+        Expired entries stay on disk until evicted and are still returned when stale is True,
+        e.g. when the upstream is down
+        '''
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+            if not stale and time.time() - stat.st_mtime > self.ttl:
+                raise FileNotFoundError(path)
+            with open(path, 'rb') as f:
+                data = f.read()
+            os.utime(path, (time.time(), stat.st_mtime))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def set(self, key:str, data:bytes):
+        '''
+        Stores the bytes for the key and evicts the least recently used entries if needed
+        '''
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        old_size = os.path.getsize(path) if os.path.exists(path) else 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += len(data) - old_size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def get_or_fetch(self, key:str, fetch, span:dict=None) -> bytes:
+        '''
+        Returns the bytes stored for the key, otherwise calls fetch() and stores its result.
+        If fetch fails and an expired entry exists, the stale entry is returned instead.
+        span (see metrics.trace) receives the cache hit and the bytes downloaded
+        '''
+        content = self.get(key)
+        if span is not None:
+            span['cache_hit'] = content is not None
+        if content is not None:
+            return content
+
+        try:
+            content = fetch()
+        except Exception:
+            content = self.get(key, stale=True)
+            if content is None:
+                raise
+            return content
+
+        if span is not None:
+            span['bytes'] = len(content)
+        self.set(key, content)
+        return content
+
+    def _remove(self, path:str):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._size -= size
+
+    def _evict(self):
+        '''
+        Removes the least recently used files until the cache is back under 90% of max_bytes
+        '''
+        entries = []
+        for path in self._files():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_atime, stat.st_size, path))
+        entries.sort()
+
+        self._size = sum(entry[1] for entry in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+                self._size -= size
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> dict:
+        '''
+        Returns the hit/miss counters and the current size of the cache
+        '''
+        return dict(hits=self.hits, misses=self.misses, size_bytes=self._size)
+
+    def clear(self):
+        for path in list(self._files()):
+            self._remove(path)
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache() -> DiskCache:
+    '''
+    Returns the DiskCache shared by the whole process
+    '''
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = DiskCache()
+    return _cache
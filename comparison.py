@@ -0,0 +1,221 @@
+import io
+import os
+import threading
+import numpy as np
+from PIL import Image
+from cachetools import TTLCache
+from concurrent.futures import Future, ThreadPoolExecutor
+from get_new_images import get_image
+from image_viz import summary, landscape_changes, image_colormap, class_trends, change_trajectories, compose_grid
+from storage import IMAGE_FORMAT, IMAGE_QUALITY
+from spatial_index import get_index
+
+#################################################
+#               COMPARISON PIPELINE             #
+#################################################
+
+# Memory used by the cached comparisons (bytes) and their time to live (seconds)
+RESULTS_MAX_BYTES = 512 * 1024 * 1024
+RESULTS_TTL = 24 * 3600
+
+# Panels of a comparison, one row per year, in the order they are rendered
+PANELS = [['image_year_1', 'changes_year_1', 'colormap_year_1'],
+          ['image_year_2', 'changes_year_2', 'colormap_year_2']]
+# Rendered comparison: maximum width sent to the browser, legend and background of the app
+RENDER_MAX_WIDTH = 1600
+LEGEND_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Labels2.png')
+BACKGROUND = (6, 5, 55)
+
+_legend = None
+
+def result_key(lat:float, lon:float, *years) -> tuple:
+    '''
+    Key of a comparison, coordinates are rounded to 5 decimals (about 1 meter)
+    '''
+    return (round(float(lat), 5), round(float(lon), 5)) + tuple(str(year) for year in years)
+
+def submit_comparison(executor, lat:float, lon:float, year_1:str, year_2:str, backend) -> dict:
+    '''
+    Submits the image fetches and the predictions to the executor (at least 3 workers).
+    Returns a dict future -> name of the result ('image_year_1', 'image_year_2' or 'predictions').
+    When a footprint already analyzed covers the location, the futures are already done
+    '''
+    nearby = nearby_comparison(lat, lon, year_1, year_2, backend)
+    if nearby is not None:
+        futures = {}
+        for name, value in nearby.items():
+            future = Future()
+            future.set_result(value)
+            futures[future] = name
+        return futures
+
+    future_1 = executor.submit(get_image, lat, lon, year_1)
+    future_2 = executor.submit(get_image, lat, lon, year_2)
+    if backend.uses_images:
+        # local backends classify the images fetched above
+        future_pred = executor.submit(lambda: backend.predict(lat, lon, year_1, year_2, future_1.result(), future_2.result()))
+    else:
+        future_pred = executor.submit(backend.predict, lat, lon, year_1, year_2)
+
+    return {
+        future_pred: 'predictions',
+        future_1: 'image_year_1',
+        future_2: 'image_year_2'}
+
+def nearby_comparison(lat:float, lon:float, year_1:str, year_2:str, backend) -> dict:
+    '''
+    Images and predictions of both years cropped from the spatial index, or None if a year is not covered
+    '''
+    crops = [get_index().crop(lat, lon, year, backend=backend.identity) for year in (year_1, year_2)]
+    if None in crops:
+        return None
+    (image_year_1, cat_year_1_np), (image_year_2, cat_year_2_np) = crops
+    if cat_year_1_np.shape != cat_year_2_np.shape:
+        return None
+    return dict(predictions=(cat_year_1_np, cat_year_2_np), image_year_1=image_year_1, image_year_2=image_year_2)
+
+def record_comparison(lat:float, lon:float, year_1:str, year_2:str, result:dict, backend):
+    '''
+    Adds the footprints of a finished comparison to the spatial index
+    '''
+    if backend.uses_images and backend.change_threshold is not None:
+        # year 2 partly copies year 1 (incremental mode), it is not a classification of that year
+        return
+    for year, image, classes in zip((year_1, year_2), (result['image_year_1'], result['image_year_2']), result['predictions']):
+        get_index().add(lat, lon, year, image, np.asarray(classes, dtype='uint8'), backend=backend.identity)
+
+def complete_result(result:dict) -> list:
+    '''
+    Adds to the result every panel that can be rendered with what has already arrived.
+    Returns the names of the new entries
+    '''
+    added = []
+    if 'predictions' in result and 'summary' not in result:
+        cat_year_1_np, cat_year_2_np = result['predictions']
+
+        # using summary function to compare results
+        result['changes'], result['summary'] = summary(cat_year_1_np, cat_year_2_np)
+        result['colormap_year_1'] = image_colormap(cat_year_1_np)
+        result['colormap_year_2'] = image_colormap(cat_year_2_np)
+        added += ['changes', 'summary', 'colormap_year_1', 'colormap_year_2']
+
+    for i in (1, 2):
+        if f'image_year_{i}' in result and 'changes' in result and f'changes_year_{i}' not in result:
+            result[f'changes_year_{i}'] = landscape_changes(result[f'image_year_{i}'], result['changes'])
+            added.append(f'changes_year_{i}')
+
+    return added
+
+def get_legend():
+    '''
+    Image with the colors of the classes, loaded once
+    '''
+    global _legend
+    if _legend is None:
+        legend = Image.open(LEGEND_FILE)
+        legend.load()
+        _legend = legend
+    return _legend
+
+def rendered_comparison(result:dict) -> bytes:
+    '''
+    Returns the encoded image of the comparison (see render_comparison), rendered on the
+    first call only and kept in the result
+    '''
+    if 'rendered' not in result:
+        result['rendered'] = render_comparison(result)
+    return result['rendered']
+
+def render_comparison(result:dict, max_width:int=RENDER_MAX_WIDTH, quality:int=IMAGE_QUALITY,
+                      img_format:str=IMAGE_FORMAT) -> bytes:
+    '''
+    Composes the six panels and the legend into one image, downscaled to max_width
+    and encoded once, so that it can be cached with the result and sent as is to every client
+    '''
+    rows = [[result[name] for name in row] for row in PANELS]
+    grid = compose_grid(rows, get_legend(), background=BACKGROUND)
+    if grid.width > max_width:
+        grid = grid.resize((max_width, round(grid.height * max_width / grid.width)), Image.BILINEAR)
+
+    output = io.BytesIO()
+    grid.save(output, format=img_format, quality=quality)
+    return output.getvalue()
+
+def compute_comparison(lat:float, lon:float, year_1:str, year_2:str, backend) -> dict:
+    '''
+    Runs the whole comparison and returns the result with all its panels
+    '''
+    result = {}
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        futures = submit_comparison(executor, lat, lon, year_1, year_2, backend)
+        for future, name in futures.items():
+            result[name] = future.result()
+    complete_result(result)
+    record_comparison(lat, lon, year_1, year_2, result, backend)
+    return result
+
+def compute_time_series(lat:float, lon:float, years:list, backend) -> dict:
+    '''
+    Fetches the images of all the years at once, classifies them as a single
+    (years, rows, cols) stack and computes the trends of the classes and the trajectories of the quadrands
+    '''
+    with ThreadPoolExecutor(max_workers=len(years) + 1) as executor:
+        image_futures = [executor.submit(get_image, lat, lon, year) for year in years]
+        if backend.uses_images:
+            pred_future = executor.submit(lambda: backend.predict_years(lat, lon, years, [future.result() for future in image_futures]))
+        else:
+            pred_future = executor.submit(backend.predict_years, lat, lon, years)
+        images = [future.result() for future in image_futures]
+        classes = pred_future.result()
+
+    return dict(years=list(years),
+                images=images,
+                classes=classes,
+                colormaps=[image_colormap(grid) for grid in classes],
+                trends=class_trends(classes),
+                trajectories=change_trajectories(classes))
+
+def result_size(value) -> int:
+    '''
+    Approximate memory used by a result in bytes
+    '''
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, dict):
+        return max(sum(result_size(item) for item in value.values()), 1)
+    if isinstance(value, (list, tuple)):
+        return sum(result_size(item) for item in value)
+    return 0
+
+class ResultsCache(object):
+    """
+    Thread safe LRU cache of comparisons, bounded by memory and with a time to live.
+    A single instance is shared by all sessions of the app
+    """
+    def __init__(self, max_bytes:int=RESULTS_MAX_BYTES, ttl:float=RESULTS_TTL):
+        self._cache = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=result_size)
+        self._lock = threading.Lock()
+
+    def get(self, key:tuple):
+        with self._lock:
+            return self._cache.get(key)
+
+    def set(self, key:tuple, result:dict):
+        with self._lock:
+            try:
+                self._cache[key] = result
+            except ValueError:
+                # result larger than the whole cache
+                pass
+
+    def __contains__(self, key:tuple) -> bool:
+        with self._lock:
+            return key in self._cache
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._cache)
@@ -0,0 +1,153 @@
+import re
+import json
+import time
+import threading
+import unicodedata
+import requests
+from cachetools import LRUCache
+from cache import get_cache
+import http_client
+from metrics import trace
+
+#################################################
+#                   GEOCODING                   #
+#################################################
+
+NOMINATIM_URL = 'https://nominatim.openstreetmap.org/search'
+# Nominatim usage policy: an absolute maximum of 1 request per second
+NOMINATIM_RATE = 1.0
+
+COORD_PATTERN = re.compile(r'(\-?\d+\.?\d*)\s*,\s*(\-?\d+\.?\d*)')
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket, 'rate' tokens are added every second up to 'capacity'
+    """
+    def __init__(self, rate:float, capacity:float=1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        '''
+        Blocks until a token is available and consumes it
+        '''
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+_limiter = TokenBucket(NOMINATIM_RATE)
+_memory = LRUCache(maxsize=4096)
+_memory_lock = threading.Lock()
+
+def normalize_query(address:str) -> str:
+    '''
+    Normalizes an address so that 'Sao paulo', ' SAO  PAULO ' and 'São Paulo' share the same key.
+    Only used for the cache keys, it can change the meaning of some scripts
+    '''
+    text = unicodedata.normalize('NFKD', address)
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    text = re.sub(r'\s+', ' ', text.casefold()).strip(' ,.;')
+    return text
+
+def parse_coordinates(address:str):
+    '''
+    Returns (lat, lon) if the address is a 'lat, lon' string, None otherwise
+    '''
+    latlon = COORD_PATTERN.search(address)
+    if latlon is None:
+        return None
+    return float(latlon.group(1)), float(latlon.group(2))
+
+def _cached(key:str, stale:bool=False):
+    with _memory_lock:
+        if key in _memory:
+            return _memory[key]
+
+    content = get_cache().get(get_cache().key('geocode', key), stale=stale)
+    if content is None:
+        return None
+
+    coords = tuple(json.loads(content))
+    with _memory_lock:
+        _memory[key] = coords
+    return coords
+
+def _store(key:str, coords:tuple):
+    with _memory_lock:
+        _memory[key] = coords
+    get_cache().set(get_cache().key('geocode', key), json.dumps(coords).encode('utf-8'))
+
+def _nominatim(query:str) -> tuple:
+    _limiter.acquire()
+    #'q' is for query --> look at hte documentation
+    params = {'q': query, 'format': 'json', 'limit': 1}
+    response = http_client.get(NOMINATIM_URL, params=params)
+    results = response.json()
+    if len(results) == 0:
+        raise ValueError(f"Address not found: {query}")
+    return float(results[0]['lat']), float(results[0]['lon'])
+
+def geocode(address:str) -> tuple:
+    '''
+    Returns the latitude and longitude for a given address or 'lat, lon' string.
+    Results are kept in memory and in the disk cache, Nominatim is called at most
+    once per second by the whole process
+    '''
+    coords = parse_coordinates(address)
+    if coords is not None:
+        return coords
+
+    with trace('address_to_coord') as span:
+        key = normalize_query(address)
+        coords = _cached(key)
+        span['cache_hit'] = coords is not None
+        if coords is None:
+            try:
+                # the key is lossy (e.g. dakuten removed), Nominatim gets the address as typed
+                coords = _nominatim(address.strip())
+            except requests.RequestException:
+                # Nominatim down: an expired result is better than nothing,
+                # but it is not stored again as if it were fresh
+                coords = _cached(key, stale=True)
+                if coords is None:
+                    raise
+            else:
+                _store(key, coords)
+    return coords
+
+def geocode_many(addresses:list, errors:list=None) -> list:
+    '''
+    Resolves many addresses at once, each distinct query hits Nominatim at most once.
+    Returns a list of (lat, lon) in the same order, None for addresses not found or when
+    Nominatim failed. If given, errors receives the reason of each failure (None on success)
+    '''
+    resolved = {}
+    reasons = {}
+    for address in addresses:
+        key = normalize_query(address)
+        if key in resolved:
+            continue
+        try:
+            resolved[key] = geocode(address)
+            reasons[key] = None
+        except ValueError:
+            resolved[key] = None
+            reasons[key] = 'address not found'
+        except requests.RequestException as e:
+            # Nominatim down or circuit open, the other addresses may be cached
+            resolved[key] = None
+            reasons[key] = f"geocoding failed: {e!r}"
+
+    if errors is not None:
+        errors.extend(reasons[normalize_query(address)] for address in addresses)
+    return [resolved[normalize_query(address)] for address in addresses]
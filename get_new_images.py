@@ -1,11 +1,21 @@
-import requests
 from PIL import Image
+import os
 import math
-import matplotlib.pyplot as plt
+import time
+import logging
+import threading
 import numpy as np
-from owslib.wms import WebMapService
 from io import BytesIO
-import regex as re
+from concurrent.futures import ThreadPoolExecutor
+from cache import get_cache
+import http_client
+from http_client import TIMEOUT, POOL_SIZE
+from geocoding import geocode
+from metrics import trace, timed
+
+TILE_URL = 'https://khms.google.com/kh/v=908'
+# Number of tiles downloaded at the same time
+MAX_WORKERS = min(9, POOL_SIZE)
 
 #################################################
 #                GET GOOGLE IMAGES              #
@@ -28,35 +38,41 @@ def latlong_to_xy(lat, lon, zoom):
     # ' -1' takes a square in the middle of a 3x3 grid
     return [column - 1, row - 1]
 
-def download_tile(x, y, z):
+def download_tile(x, y, z, timeout=TIMEOUT, tile_size=256):
     '''
     Downloads a tile for the given x and y coordinates and zoom level.
-    It is pretty slow as it downloads one tile at a time
+    Uses the shared session, so consecutive calls reuse the same connection.
+    A tile_size of 256/2, 256/4 or 256/8 decodes the JPEG directly at that size (draft mode)
     '''
-    url = "https://khms.google.com/kh/v=908?x=" + str(x) + "&y=" + str(y) + "&z=" + str(z)
-    response = requests.get(url)
-    bytes_io = BytesIO(response.content)
+    url = TILE_URL + "?x=" + str(x) + "&y=" + str(y) + "&z=" + str(z)
+    with trace('download_tile') as span:
+        cache = get_cache()
+        key = cache.key('tile', x, y, z)
+        content = cache.get_or_fetch(key, lambda: http_client.get(url, timeout=timeout).content, span)
+
+    bytes_io = BytesIO(content)
     PIL_image = Image.open(bytes_io)
+    if tile_size < PIL_image.width:
+        PIL_image.draft('RGB', (tile_size, tile_size))
+    PIL_image.load()
+    if PIL_image.width > tile_size:
+        # not a JPEG, draft did nothing
+        PIL_image = PIL_image.reduce(PIL_image.width // tile_size)
     return PIL_image
 
-def dl_square(x, y, z, size=3):
+def dl_square(x, y, z, size=3, max_workers=MAX_WORKERS, tile_size=256):
     '''
-    Downloads a square of tiles, might add other shapes later
+    Downloads a square of size x size tiles, at most 'max_workers' tiles at the same time
     '''
-    imgs = {}
-    max_x = x + size - 1
-    max_y = y + size - 1
-    y2 = y
+    coords = [(x + i, y + j) for i in range(size) for j in range(size)]
 
-    while x <= max_x:
-        while y <= max_y:
-            imgs[f"{x}_{y}"] = download_tile(x, y, z)
-            y += 1
-        y = y2
-        x += 1
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(coords))) as executor:
+        tiles = executor.map(lambda c: download_tile(c[0], c[1], z, tile_size=tile_size), coords)
+        imgs = {f"{c[0]}_{c[1]}": tile for c, tile in zip(coords, tiles)}
 
     return imgs
 
+@timed()
 def stitch_tiles(imgs, x, y, size=3, img_size=256):
     '''
     Stitches tiles into one large image
@@ -86,12 +102,11 @@ def stitch_tiles(imgs, x, y, size=3, img_size=256):
 
     return output
 
-def calculate_zoom(lat: float):
+def calculate_zoom(lat: float, meters_per_pixel: float = 10):
     '''
-    Defines the zoom level closest to 10 meters per pixel
+    Defines the zoom level closest to 10 meters per pixel (or to meters_per_pixel)
     156543.03392 * Math.cos(latLng.lat() * Math.PI / 180) / Math.pow(2, zoom)
     '''
-    meters_per_pixel = 10
     zoom = round(math.log(156543.03392 * math.cos(lat * math.pi / 180) / meters_per_pixel, 2), 0)
     return int(zoom)
 
@@ -118,33 +133,195 @@ def image_crop(img):
     crop_pix = int(img.height / 64) * 64
     return img.crop((0,0,crop_pix,crop_pix))
 
-def get_google_image(lat:float, lon:float):
+def google_window(lat:float, zoom:int, meters_per_pixel:float=10, grid_size:int=3) -> dict:
+    '''
+    Computes what is needed to turn the grid_size x grid_size tiles at the given zoom into an image
+    at meters_per_pixel whose side is a multiple of 64 pixels:
+        output_size: side of the output image in pixels
+        source_size: side of the window of the stitched tiles covering the output (pixels of the tiles)
+        n_tiles: number of tiles per side covering the window
+        draft: power of 2 by which the JPEG tiles can be reduced while decoding (1, 2, 4 or 8)
+    '''
+    tile_meters_per_pixel = calc_meters_per_pixel(lat, zoom)
+    scale = tile_meters_per_pixel / meters_per_pixel
+
+    # floored, so that the window never exceeds the tiles
+    output_size = int(grid_size * 256 * scale) // 64 * 64
+    source_size = min(output_size / scale, grid_size * 256)
+    n_tiles = min(grid_size, math.ceil(source_size / 256))
+
+    draft = 1
+    while draft < 8 and scale * draft * 2 <= 1:
+        draft *= 2
+
+    return dict(output_size=output_size, source_size=source_size, n_tiles=n_tiles, draft=draft)
+
+@timed()
+def get_google_image(lat:float, lon:float, meters_per_pixel:float=10, zoom:int=None, resample=Image.BICUBIC):
     """
     Given the GPS coordinate, retuns an RGB image from google maps
     centered around the given point with resolution of 10m/pixel.
 
+    Only the tiles covering the output are downloaded, and the stitched tiles are cropped
+    and resampled in a single step.
+
     Arguments:
         lat: latitude of the central point (float)
         lon: longitude of the central point (float)
+        meters_per_pixel: resolution of the returned image
+        zoom: zoom level of the tiles, the closest to meters_per_pixel by default
+        resample: Pillow filter used to resample the tiles
 
     Returns:
         An RGB image stored in a PIL.Image
     """
-    zoom = calculate_zoom(lat)
+    if zoom is None:
+        zoom = calculate_zoom(lat, meters_per_pixel)
     coords = latlong_to_xy(lat, lon, zoom)
-    imgs = dl_square(coords[0], coords[1], zoom)
-    stitched_image = stitch_tiles(imgs, coords[0], coords[1])
-    meters_per_pixel = calc_meters_per_pixel(lat, zoom)
+    window = google_window(lat, zoom, meters_per_pixel)
 
-    img = image_resize(meters_per_pixel, stitched_image)
-    img = image_crop(img)
+    tile_size = 256 // window['draft']
+    imgs = dl_square(coords[0], coords[1], zoom, window['n_tiles'], tile_size=tile_size)
+    stitched_image = stitch_tiles(imgs, coords[0], coords[1], window['n_tiles'], tile_size)
 
-    return img
+    source_size = min(window['source_size'] / window['draft'], stitched_image.width)
+    output_size = (window['output_size'], window['output_size'])
+    return stitched_image.resize(output_size, resample, box=(0, 0, source_size, source_size))
 
 #################################################
 #                GET S2MAPS IMAGES             #
 #################################################
 
+WMS_URL = 'https://tiles.maps.eox.at/wms'
+# Years with a s2cloudless-{year} layer (2017 covers Europe only)
+S2MAPS_YEARS = ['2017', '2018', '2019', '2020']
+# Seconds before the GetCapabilities document is downloaded again
+CAPABILITIES_REFRESH = 24 * 3600
+# Not inside the disk cache folder, whose eviction and clear() would delete it
+CAPABILITIES_FILE = os.environ.get('WFA_CAPABILITIES_FILE', '.wfa_capabilities.xml')
+# Seconds between two downloads of the capabilities while they keep failing
+CAPABILITIES_RETRY = 300
+
+logger = logging.getLogger(__name__)
+
+_wms = None
+_wms_loaded_at = 0.0
+_wms_attempted_at = 0.0
+_wms_lock = threading.Lock()
+_wms_refreshing = False
+
+def _web_map_service(xml:bytes):
+    # owslib (and its lxml/dateutil dependencies) is only loaded once capabilities are parsed
+    from owslib.wms import WebMapService
+    return WebMapService(WMS_URL, xml=xml)
+
+def _load_capabilities():
+    '''
+    Downloads and parses the GetCapabilities document, then stores it in CAPABILITIES_FILE
+    so that other processes (and restarts) can reuse it
+    '''
+    global _wms, _wms_loaded_at, _wms_refreshing
+    try:
+        with trace('wms_capabilities') as span:
+            response = http_client.get(WMS_URL, params={'service': 'wms', 'request': 'getcapabilities'})
+            span['bytes'] = len(response.content)
+            wms = _web_map_service(response.content)
+
+        os.makedirs(os.path.dirname(CAPABILITIES_FILE) or '.', exist_ok=True)
+        tmp_file = f"{CAPABILITIES_FILE}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            f.write(response.content)
+        os.replace(tmp_file, CAPABILITIES_FILE)
+
+        with _wms_lock:
+            _wms = wms
+            _wms_loaded_at = time.time()
+    except Exception:
+        # raw GetMap requests are used meanwhile, get_wms tries again after CAPABILITIES_RETRY
+        logger.warning("Could not load the WMS capabilities of %s", WMS_URL, exc_info=True)
+    finally:
+        with _wms_lock:
+            _wms_refreshing = False
+
+def get_wms():
+    '''
+    Returns the WebMapService shared by all threads and sessions of the process.
+
+    The capabilities are read from CAPABILITIES_FILE when it is recent enough, otherwise
+    they are refreshed in a background thread, at most once every CAPABILITIES_RETRY seconds.
+    While they are missing or stale, None is returned and the caller is expected to issue
+    raw GetMap requests (see getmap_raw).
+    '''
+    global _wms, _wms_loaded_at, _wms_attempted_at, _wms_refreshing
+    with _wms_lock:
+        if _wms is not None and time.time() - _wms_loaded_at < CAPABILITIES_REFRESH:
+            return _wms
+
+        if _wms is None and os.path.exists(CAPABILITIES_FILE):
+            file_time = os.path.getmtime(CAPABILITIES_FILE)
+            if time.time() - file_time < CAPABILITIES_REFRESH:
+                try:
+                    with open(CAPABILITIES_FILE, 'rb') as f:
+                        _wms = _web_map_service(f.read())
+                    _wms_loaded_at = file_time
+                    return _wms
+                except Exception:
+                    _wms = None
+
+        if not _wms_refreshing and time.time() - _wms_attempted_at >= CAPABILITIES_RETRY:
+            _wms_refreshing = True
+            _wms_attempted_at = time.time()
+            threading.Thread(target=_load_capabilities, daemon=True).start()
+
+    return None
+
+def getmap_raw(layer:str, extent:list, width:int, height:int, img_format:str="image/jpeg", timeout=TIMEOUT) -> bytes:
+    '''
+    Issues a WMS 1.1.1 GetMap request without going through the capabilities document
+    '''
+    params = dict(service='WMS',
+                  version='1.1.1',
+                  request='GetMap',
+                  layers=layer,
+                  styles='',
+                  srs='EPSG:4326',
+                  bbox=','.join(str(value) for value in extent),
+                  width=width,
+                  height=height,
+                  format=img_format)
+    response = http_client.get(WMS_URL, params=params, timeout=timeout)
+    if not response.headers.get('Content-Type', '').startswith('image'):
+        raise ValueError(f"WMS GetMap did not return an image: {response.text[:200]}")
+    return response.content
+
+def get_s2maps_bytes(layer:str, extent:list, width:int, height:int, img_format:str="image/jpeg") -> bytes:
+    '''
+    Returns the encoded image of a WMS GetMap request, from the disk cache when possible.
+    extent is [lon_min, lat_min, lon_max, lat_max] in EPSG:4326
+    '''
+    def fetch():
+        wms = get_wms()
+
+        if wms is not None and layer in wms.contents:
+            with http_client.guarded(WMS_URL):
+                response = wms.getmap(
+                    layers=[layer],
+                    size=[width, height],
+                    srs="EPSG:4326",
+                    bbox=extent,
+                    format=img_format,
+                    timeout=TIMEOUT[1])
+                return response.read()
+        else:
+            return getmap_raw(layer, extent, width, height, img_format)
+
+    with trace('get_s2maps_data') as span:
+        cache = get_cache()
+        key = cache.key('wms', layer, *[f"{value:.6f}" for value in extent], width, height, img_format)
+        content = cache.get_or_fetch(key, fetch, span)
+
+    return content
+
 def get_s2maps_data(lat:float, lon:float, year:str, size_km:float=6.4) -> Image:
     """
     Given the image side size in km and a GPS coordinate, retuns an RGB image centered
@@ -160,23 +337,16 @@ def get_s2maps_data(lat:float, lon:float, year:str, size_km:float=6.4) -> Image:
         An RGB image stored in a PIL.Image
 
     """
-    url = 'https://tiles.maps.eox.at/wms?service=wms&request=getcapabilities'
-    wms = WebMapService(url)
-
     bbox = get_bounding_box(lat, lon, size_km/2)
 
     # Get new image
     pixels = int(size_km * 100)
+    #Bounding box for map extent. Value is minx,miny,maxx,maxy in units of the SRS. Left, bottom, right, top
+    extent = [bbox.lon_min, bbox.lat_min, bbox.lon_max, bbox.lat_max]
 
-    response = wms.getmap(
-        layers=[f"s2cloudless-{year}"],
-        size=[pixels, pixels],
-        srs="EPSG:4326",
-        #Bounding box for map extent. Value is minx,miny,maxx,maxy in units of the SRS. Left, bottom, right, top
-        bbox=[bbox.lon_min, bbox.lat_min, bbox.lon_max, bbox.lat_max],
-        format="image/jpeg")
+    content = get_s2maps_bytes(f"s2cloudless-{year}", extent, pixels, pixels)
 
-    bytes_io = BytesIO(response.read())
+    bytes_io = BytesIO(content)
     PIL_image = Image.open(bytes_io)
     return PIL_image
 
@@ -234,54 +404,83 @@ def get_bounding_box(latitude_in_degrees : float, longitude_in_degrees : float,
 
 def address_to_coord(address):
     '''
-    Returns the latitude and longitude for a given address
+    Returns the latitude and longitude for a given address (see geocoding.geocode)
     '''
-    latlon = re.search(r'\-?\d+\.?\d*\s*,\s*\-?\d+\.?\d*', address)
-    if latlon != None:
-        text = latlon.string
-        text = text.split(',')
-        lat = float(text[0].strip())
-        longi = float(text[1].strip())
-    else:
-        url = 'https://nominatim.openstreetmap.org/search'
-        #'q' is for query --> look at hte documentation
-        params = {'q': address, 'format': 'json'}
-        response = requests.get(url, params = params).json()
-        lat = float(response[0]['lat'])
-        longi = float(response[0]['lon'])
-
-    return lat, longi
+    return geocode(address)
 
-def get_new_image(adr:str, year:str) -> Image:
+def get_image(lat:float, lon:float, year:str) -> Image:
     """
-    Given the address or GPS coordinate, retuns an RGB image from google maps
+    Given a GPS coordinate, retuns an RGB image from google maps
     or from s2maps depending on the requested year centered around the given point with resolution of 10m/pixel.
 
     Arguments:
         lat: latitude of the central point (float)
         lon: longitude of the central point (float)
+        year: 'Google' or year of historical data, 4 options among [2017,2018,2019,2020]
 
     Returns:
         An RGB image stored in a PIL.Image
     """
-
-    lat, lon = address_to_coord(adr)
-
     if year == 'Google':
         return get_google_image(lat, lon)
     else:
         return get_s2maps_data(lat, lon, year)
 
-def split_tiles(img : Image) -> np.array:
+def get_new_image(adr:str, year:str) -> Image:
     """
-    Given a big image, crop it into small images (tiles) of 64x64 pixels
+    Given the address or GPS coordinate, retuns an RGB image from google maps
+    or from s2maps depending on the requested year centered around the given point with resolution of 10m/pixel.
+
+    Arguments:
+        adr: address or GPS coordinates 'lat, lon' (str)
+        year: 'Google' or year of historical data, 4 options among [2017,2018,2019,2020]
+
+    Returns:
+        An RGB image stored in a PIL.Image
+    """
+
+    lat, lon = address_to_coord(adr)
+    return get_image(lat, lon, year)
+
+def tile_view(arr:np.ndarray, tile_size:int=64, stride:int=None) -> np.ndarray:
     """
+    Returns a read-only (rows, cols, tile_size, tile_size, channels) view of the tiles of an image array,
+    without copying any pixel. Tiles overlap when stride < tile_size, pixels left over on the
+    right and bottom borders are ignored
+    """
+    stride = stride or tile_size
+    height, width = arr.shape[:2]
+    rows = (height - tile_size) // stride + 1
+    cols = (width - tile_size) // stride + 1
+    step_y, step_x = arr.strides[:2]
+
+    return np.lib.stride_tricks.as_strided(arr,
+                                           shape=(rows, cols, tile_size, tile_size) + arr.shape[2:],
+                                           strides=(step_y*stride, step_x*stride, step_y, step_x) + arr.strides[2:],
+                                           writeable=False)
+
+@timed()
+def split_tiles(img : Image, tile_size:int=64, stride:int=None, dtype=None, flat:bool=True) -> np.array:
+    """
+    Given a big image, crop it into small images (tiles) of 64x64 pixels
 
-    tiles = []
-    quads = int(img.height/64)
+    Arguments:
+        img: PIL.Image or np.ndarray (height, width, channels)
+        tile_size: side of the tiles in pixels
+        stride: distance in pixels between two tiles, tile_size by default (no overlap)
+        dtype: dtype of the returned tiles, the dtype of the image by default
+        flat: if False, returns the (rows, cols, tile_size, tile_size, channels) view without any copy
 
-    for j in range(quads):
-        for i in range(quads):
-            temp_tile = np.array(img.crop((i*64, j*64, i*64+64, j*64+64)))
-            tiles.append(temp_tile)
-    return np.array(tiles)
+    Returns:
+        A (N, tile_size, tile_size, channels) np.array, tiles ordered row by row
+    """
+    tiles = tile_view(np.asarray(img), tile_size, stride)
+    if not flat and (dtype is None or tiles.dtype == dtype):
+        return tiles
+
+    # single copy, converting the dtype on the way
+    out = np.empty(tiles.shape, dtype=dtype or tiles.dtype)
+    out[...] = tiles
+    if not flat:
+        return out
+    return out.reshape((-1,) + tiles.shape[2:])
@@ -0,0 +1,145 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
+import threading
+from urllib.parse import urlparse
+from contextlib import contextmanager
+
+#################################################
+#                  HTTP SESSION                 #
+#################################################
+
+# Seconds to wait for a connection / for the response
+TIMEOUT = (3.05, 10)
+# Number of retries of a single request before giving up
+RETRIES = 3
+# Number of keep-alive connections kept open per host
+POOL_SIZE = 10
+# Sent to every upstream, Nominatim requires an identifying User-Agent
+USER_AGENT = 'watching-from-above (https://github.com/pabloknecht/wfa-streamlit)'
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+def get_session(retry_reads:bool=True) -> requests.Session:
+    '''
+    Returns a requests.Session shared by the whole process.
+    The keep-alive connection pool allows POOL_SIZE parallel requests per host
+    and failed requests are retried with an exponential backoff.
+    With retry_reads=False, a request whose response times out is not sent again
+    (long timeouts, e.g. the prediction API, would otherwise hold the thread RETRIES+1 times longer)
+    '''
+    with _session_lock:
+        if retry_reads not in _sessions:
+            retry = Retry(total=RETRIES,
+                          read=None if retry_reads else 0,
+                          backoff_factor=0.3,
+                          status_forcelist=(429, 500, 502, 503, 504),
+                          allowed_methods=("GET",))
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.headers['User-Agent'] = USER_AGENT
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            _sessions[retry_reads] = session
+    return _sessions[retry_reads]
+
+#################################################
+#          CONCURRENCY AND CIRCUIT BREAKER      #
+#################################################
+
+# Requests running at the same time per host, Nominatim allows a single one
+HOST_CONCURRENCY = {'nominatim.openstreetmap.org': 1}
+DEFAULT_HOST_CONCURRENCY = 8
+# Consecutive failures opening the circuit of a host, and seconds before trying it again
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30
+
+class CircuitOpenError(requests.ConnectionError):
+    """
+    Raised without calling the host while its circuit is open
+    """
+
+class CircuitBreaker(object):
+    """
+    Opens after FAILURE_THRESHOLD consecutive failures, then lets a single trial request
+    through every RESET_TIMEOUT seconds until one succeeds
+    """
+    def __init__(self, host:str, failure_threshold:int=FAILURE_THRESHOLD, reset_timeout:float=RESET_TIMEOUT):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_request(self):
+        with self._lock:
+            if self.opened_at is None:
+                return
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.host} is unavailable, circuit open")
+            # half open: this request is the trial, the others keep failing fast
+            self.opened_at = time.monotonic()
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+_hosts = {}
+_hosts_lock = threading.Lock()
+
+def _host(url:str) -> tuple:
+    host = urlparse(url).hostname or ''
+    with _hosts_lock:
+        if host not in _hosts:
+            limit = HOST_CONCURRENCY.get(host, DEFAULT_HOST_CONCURRENCY)
+            _hosts[host] = (threading.BoundedSemaphore(limit), CircuitBreaker(host))
+        return _hosts[host]
+
+def get_breaker(url:str) -> CircuitBreaker:
+    return _host(url)[1]
+
+@contextmanager
+def guarded(url:str):
+    '''
+    Applies the concurrency limit and the circuit breaker of the host of url to the block,
+    for requests that do not go through get (e.g. owslib)
+    '''
+    semaphore, breaker = _host(url)
+    breaker.before_request()
+    with semaphore:
+        try:
+            yield
+        except requests.HTTPError as e:
+            # client errors (404...) do not mean that the host is down
+            status = e.response.status_code if e.response is not None else 500
+            if status >= 500 or status == 429:
+                breaker.failure()
+            raise
+        except (requests.RequestException, OSError):
+            breaker.failure()
+            raise
+    breaker.success()
+
+def get(url:str, params:dict=None, timeout=TIMEOUT, retry_reads:bool=True) -> requests.Response:
+    '''
+    GET through the shared session with timeouts, retries, the concurrency limit of the host
+    and its circuit breaker. Server errors (5xx) raise requests.HTTPError
+    '''
+    with guarded(url):
+        response = get_session(retry_reads).get(url, params=params, timeout=timeout)
+        response.raise_for_status()
+    return response
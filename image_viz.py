@@ -1,147 +1,184 @@
-import matplotlib.pyplot as plt
 from PIL import Image
 import pandas as pd
 import numpy as np
-from get_new_images import stitch_tiles
-from matplotlib import cm
-
-def plot_image_categories(img, classes):
-    '''
-    Plot the image with the quadrants and correspondent classes
-    '''
-    xs = range(64, img.height, 64)
-    xt = range(20, img.height, 64)
-    yt = range(44, img.height, 64)
-    plt.imshow(img)
-    # multiple lines all full height
-    plt.vlines(x=xs, ymin=0, ymax=img.height-1, colors='red', ls='-', lw=0.5)
-    plt.hlines(y=xs, xmin=0, xmax=img.height-1, colors='red', ls='-', lw=0.5)
-    for item_y,value_y in enumerate(yt):
-        for item_x,value_x in enumerate(xt):
-            plt.text(value_x, value_y, classes[item_y, item_x], color = 'red')
-    plt.show()
-
-def plot_sub_images_categories(img, classes):
-    '''
-    Plot a grid of tiles contained in X_new (PIL) with its correspondent predicted classes
-    '''
-    quads = int(img.height/64)
-    fig, axs = plt.subplots(quads, quads, figsize = (10, 10))
-    for i in range(quads):
-        for j in range(quads):
-            img_quad = img.crop((i*64, j*64, i*64+64, j*64+64))
-            axs[j, i].imshow(img_quad)
-            axs[j, i].text(22, 40, classes[j, i], color = 'red')
-            axs[j, i].axis('off')
-    plt.show()
-
-def plot_classified_images(X_new, y_pred_class):
-    """
-    Plot a grid of tiles contained in X_new (np.array) with its correspondent predicted classes
-    """
-    size = int(X_new.shape[0] ** 0.5)
-    X_reshaped = X_new.reshape((size,size,64,64,3))
-    fig, axs = plt.subplots(size, size, figsize = (10, 10))
-    for i in range(size) :
-        for j in range(size) :
-            axs[j, i].imshow(X_reshaped[i,j])
-            axs[j, i].text(22, 40, y_pred_class[j, i], color = 'red')
-            axs[j, i].axis('off')
-    plt.show()
+from metrics import timed
+
+# Helpers moved to plotting.py, still importable from here without loading matplotlib upfront
+PLOT_HELPERS = ('plot_image_categories', 'plot_sub_images_categories', 'plot_classified_images')
+
+def __getattr__(name):
+    if name in PLOT_HELPERS:
+        import plotting
+        return getattr(plotting, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+# EuroSAT classes, the position in the list is the ID predicted by the model
+CLASSES = np.array([
+    'AnnualCrop',
+    'Forest',
+    'HerbaceousVegetation',
+    'Highway',
+    'Industrial',
+    'Pasture',
+    'PermanentCrop',
+    'Residential',
+    'River',
+    'SeaLake',
+    ])
+N_CLASSES = len(CLASSES)
+
+# Colors of the classes, the 'tab10' palette of matplotlib
+TAB10 = np.array([
+    [31, 119, 180],
+    [255, 127, 14],
+    [44, 160, 44],
+    [214, 39, 40],
+    [148, 103, 189],
+    [140, 86, 75],
+    [227, 119, 194],
+    [127, 127, 127],
+    [188, 189, 34],
+    [23, 190, 207],
+    ], dtype='uint8')
+
+def transition_matrix(y_pred_class1:np.ndarray,
+                      y_pred_class2:np.ndarray) -> np.ndarray:
+    '''
+    Returns a (N_CLASSES, N_CLASSES) matrix where [i, j] is the number of quadrands
+    classified as i in the first image and as j in the second one
+    '''
+    pairs = y_pred_class1.ravel().astype('int64') * N_CLASSES + y_pred_class2.ravel()
+    return np.bincount(pairs, minlength=N_CLASSES**2).reshape((N_CLASSES, N_CLASSES))
+
+@timed()
+def class_trends(y_pred_classes:np.ndarray) -> np.ndarray:
+    '''
+    Receives the (years, rows, cols) stack of predicted classes and returns a (years, N_CLASSES)
+    array with the share of each class every year
+    '''
+    n_years = y_pred_classes.shape[0]
+    flat = y_pred_classes.reshape((n_years, -1)).astype('int64')
+    # one block of N_CLASSES bins per year
+    counts = np.bincount((flat + np.arange(n_years)[:, None] * N_CLASSES).ravel(), minlength=n_years * N_CLASSES)
+    return counts.reshape((n_years, N_CLASSES)) / flat.shape[1]
+
+@timed()
+def change_trajectories(y_pred_classes:np.ndarray) -> dict:
+    '''
+    Receives the (years, rows, cols) stack of predicted classes and returns, for every quadrand:
+        n_changes: number of years where the class changed
+        first_change: index of the first year with a new class, -1 if the class never changed
+        last_change: index of the last year with a new class, -1 if the class never changed
+        changed: 1 if the class of the last year differs from the first year
+    '''
+    steps = y_pred_classes[1:] != y_pred_classes[:-1]
+    any_change = steps.any(axis=0)
+    first_change = np.where(any_change, np.argmax(steps, axis=0) + 1, -1)
+    last_change = np.where(any_change, steps.shape[0] - np.argmax(steps[::-1], axis=0), -1)
+
+    return dict(n_changes=steps.sum(axis=0),
+                first_change=first_change,
+                last_change=last_change,
+                changed=(y_pred_classes[-1] != y_pred_classes[0]).astype('int64'))
 
+@timed()
 def summary(y_pred_class1:np.ndarray,
-            y_pred_class2:np.ndarray):
+            y_pred_class2:np.ndarray,
+            transitions:bool=False):
+    '''
+    Compares the classes predicted for two images.
+    Returns the changes mask (1 where the class changed), the summary table with the share
+    of each class in both images and, if transitions is True, the transition_matrix
+    '''
     if y_pred_class1.shape != y_pred_class2.shape:
          print('Images have different shapes, please check!')
     else:
-        changes = pd.DataFrame(y_pred_class1 - y_pred_class2).applymap(lambda x: 1 if x != 0 else 0).to_numpy()
-
-        inv_classes = {
-            0:'AnnualCrop',
-            1:'Forest',
-            2:'HerbaceousVegetation',
-            3:'Highway',
-            4:'Industrial',
-            5:'Pasture',
-            6:'PermanentCrop',
-            7:'Residential',
-            8:'River',
-            9:'SeaLake',
-            }
-        pred1 = pd.DataFrame(y_pred_class1.reshape((y_pred_class1.shape[0]*y_pred_class1.shape[1]))).value_counts(normalize=True).rename_axis('cat_ID').reset_index(name='year1')
-        pred2 = pd.DataFrame(y_pred_class2.reshape((y_pred_class2.shape[0]*y_pred_class2.shape[1]))).value_counts(normalize=True).rename_axis('cat_ID').reset_index(name='year2')
-
-        summary = pred1.merge(pred2, how='outer')
-        summary.fillna(0, inplace=True)
-        summary['diff'] = summary['year2']-summary['year1']
-        summary['cat_name'] = summary['cat_ID'].apply(lambda x: inv_classes[x])
-        summary = summary[['cat_ID', 'cat_name', 'year1', 'year2', 'diff']].set_index('cat_ID')
-        summary['year1'] = pd.Series(["{0:.0f}%".format(val * 100) for val in summary['year1']], index = summary.index)
-        summary['year2'] = pd.Series(["{0:.0f}%".format(val * 100) for val in summary['year2']], index = summary.index)
-        summary['diff'] = pd.Series(["{0:.0f}%".format(val * 100) for val in summary['diff']], index = summary.index)
+        changes = (y_pred_class1 != y_pred_class2).astype('int64')
+
+        matrix = transition_matrix(y_pred_class1, y_pred_class2)
+        year1 = matrix.sum(axis=1) / y_pred_class1.size
+        year2 = matrix.sum(axis=0) / y_pred_class2.size
+        cat_ID = np.flatnonzero(year1 + year2)
+
+        summary = pd.DataFrame({
+            'cat_name': CLASSES[cat_ID],
+            'year1': np.char.mod('%.0f%%', year1[cat_ID] * 100),
+            'year2': np.char.mod('%.0f%%', year2[cat_ID] * 100),
+            'diff': np.char.mod('%.0f%%', (year2 - year1)[cat_ID] * 100),
+            }, index=pd.Index(cat_ID, name='cat_ID'))
+
+        if transitions:
+            return changes, summary, matrix
         return changes, summary
 
+def expand_grid(grid:np.ndarray, tile_size:int=64) -> np.ndarray:
+    '''
+    Expands every cell of a (rows, cols, 3) grid into a tile_size x tile_size block.
+    Returns a (rows*tile_size, cols*tile_size, 3) uint8 array written in a single buffer
+    '''
+    rows, cols, channels = grid.shape
+    # one line of pixels per row of the grid, then broadcast it tile_size times
+    lines = np.repeat(grid.astype('uint8'), tile_size, axis=1)
+    out = np.empty((rows, tile_size, cols*tile_size, channels), dtype='uint8')
+    out[...] = lines[:, None]
+    return out.reshape((rows*tile_size, cols*tile_size, channels))
+
+@timed()
 def landscape_changes(image, changes):
     '''
     This function receives an image (PIL) and the np.array with the category changes and return an image with white squares
     where there was no change in the categories
     '''
-    white_box = np.full((64,64,3), 255, dtype='uint8')
-    white_box = Image.fromarray(white_box)
-    imgs = {}
-
-    max_x = int(image.size[0]/64)
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    rows, cols = changes.shape
+    img = np.asarray(image)[:rows*64, :cols*64]
 
-    for x in range(max_x):
-        for y in range(max_x):
-            if changes[y,x] == 0:
-                imgs[f"{x}_{y}"] = white_box
-            else:
-                imgs[f"{x}_{y}"] = image.crop((x*64, y*64, x*64+64, y*64+64))
+    # 255 on every pixel of the unchanged quadrands, 0 elsewhere, one line per row of quadrands
+    white = np.repeat((changes == 0).astype('uint8') * 255, 64*3, axis=1)
+    tiles = img.reshape((rows, 64, cols*64*3))
+    img = np.maximum(tiles, white[:, None, :]).reshape((rows*64, cols*64, 3))
 
-    img = stitch_tiles(imgs, 0, 0, max_x, 64)
-    return img
+    return Image.fromarray(img)
 
+@timed()
 def image_colormap(y_pred):
     '''
     This function receives an np.array with the predicted classes and return a colored image with the classification of each quadrand
     '''
-    # get the 10 colors from 'tab10' pallet of matplotlib
-    colors = np.array(cm.tab10.colors)
-    colors = colors*255
-    colors = colors.astype('uint8')
-
-    # converts into images
-    boxes = []
-    for i in range(10):
-        boxes.append(Image.fromarray(np.full((64,64,3), colors[i])))
-
-    size = y_pred.shape[0]
-    imgs = {}
-    for y in range(size):
-        for x in range(size):
-            imgs[f"{x}_{y}"] = boxes[y_pred[y,x]]
-
-    img = stitch_tiles(imgs, 0, 0, size, 64)
-    return img
+    img = expand_grid(TAB10[y_pred], 64)
+    return Image.fromarray(img)
 
+@timed()
 def image_colormap_changes(changes):
     '''
     This function receives an np.array with the changes and return a black & white image with the changes in each quadrand
     '''
-    color1 = np.array([255, 192, 0])
-    color1_box = np.full((64,64,3), color1)
-    color1_box = Image.fromarray(color1_box)
-
-    color2 = np.array([0, 255, 0])
-    color2_box = np.full((64,64,3), color2)
-    color2_box = Image.fromarray(color2_box)
+    # color of unchanged / changed quadrands
+    colors = np.array([[255, 192, 0], [0, 255, 0]], dtype='uint8')
 
-    size = changes.shape[0]
-    imgs = {}
-    for y in range(size):
-        for x in range(size):
-            imgs[f"{x}_{y}"] = color1_box if changes[y,x] == 0 else color2_box
+    img = expand_grid(colors[(changes != 0).astype('uint8')], 64)
+    return Image.fromarray(img)
 
-    img = stitch_tiles(imgs, 0, 0, size, 64)
-    return img
+def compose_grid(rows:list, legend=None, gap:int=8, background:tuple=(255, 255, 255)):
+    '''
+    Pastes rows of PIL images into a single RGB image, every cell has the size of the largest image.
+    The legend (if any) is added on the right of the first row
+    '''
+    cell_w = max(image.width for row in rows for image in row)
+    cell_h = max(image.height for row in rows for image in row)
+    n_cols = max(len(row) for row in rows)
+    width = n_cols * (cell_w + gap) - gap
+    height = len(rows) * (cell_h + gap) - gap
+    if legend is not None:
+        width += gap + legend.width
+        height = max(height, legend.height)
+
+    grid = Image.new('RGB', (width, height), background)
+    for i, row in enumerate(rows):
+        for j, image in enumerate(row):
+            grid.paste(image.convert('RGB'), (j * (cell_w + gap), i * (cell_h + gap)))
+    if legend is not None:
+        legend = legend.convert('RGBA')
+        grid.paste(legend, (n_cols * (cell_w + gap), 0), legend)
+    return grid
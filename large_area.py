@@ -0,0 +1,130 @@
+import math
+import numpy as np
+from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from get_new_images import BoundingBox, get_s2maps_bytes, tile_view
+
+#################################################
+#                LARGE AREA MODE                #
+#################################################
+
+# Side in pixels of a single WMS sub-request (10 tiles of 64 pixels)
+CHUNK_PIXELS = 640
+# Number of WMS sub-requests running at the same time
+MAX_WORKERS = 4
+# Number of tiles sent to the classifier at once
+BATCH_TILES = 256
+# Radius of the earth in km, same value as get_bounding_box
+RADIUS = 6371
+
+def area_bounding_box(lat_min:float, lon_min:float, lat_max:float, lon_max:float) -> BoundingBox:
+    '''
+    Creates a BoundingBox from its two corners
+    '''
+    assert lat_min < lat_max and lon_min < lon_max
+    box = BoundingBox()
+    box.lat_min = lat_min
+    box.lon_min = lon_min
+    box.lat_max = lat_max
+    box.lon_max = lon_max
+    return box
+
+def pixels_per_degree(bbox:BoundingBox) -> tuple:
+    '''
+    Returns the number of 10 meters pixels in one degree of latitude and in one degree
+    of longitude at the center of the bounding box
+    '''
+    lat = math.radians((bbox.lat_min + bbox.lat_max) / 2)
+    per_lat = math.radians(1) * RADIUS * 100
+    return per_lat, per_lat * math.cos(lat)
+
+def area_pixels(bbox:BoundingBox) -> tuple:
+    '''
+    Returns the (height, width) in pixels of the bounding box at 10m/pixel,
+    rounded down to a multiple of 64 pixels
+    '''
+    per_lat, per_lon = pixels_per_degree(bbox)
+    height = int((bbox.lat_max - bbox.lat_min) * per_lat) // 64 * 64
+    width = int((bbox.lon_max - bbox.lon_min) * per_lon) // 64 * 64
+    return height, width
+
+def split_area(bbox:BoundingBox, chunk_pixels:int=CHUNK_PIXELS) -> list:
+    '''
+    Splits the bounding box into WMS sub-requests of at most chunk_pixels x chunk_pixels.
+    The area is anchored on its top left corner and shrunk to a multiple of 64 pixels.
+
+    Returns a list of (top, left, height, width, extent), top and left being the position
+    in pixels of the sub-request in the mosaic and extent its [lon_min, lat_min, lon_max, lat_max]
+    '''
+    height, width = area_pixels(bbox)
+    per_lat, per_lon = pixels_per_degree(bbox)
+
+    sub_requests = []
+    for top in range(0, height, chunk_pixels):
+        for left in range(0, width, chunk_pixels):
+            h = min(chunk_pixels, height - top)
+            w = min(chunk_pixels, width - left)
+            extent = [bbox.lon_min + left / per_lon,
+                      bbox.lat_max - (top + h) / per_lat,
+                      bbox.lon_min + (left + w) / per_lon,
+                      bbox.lat_max - top / per_lat]
+            sub_requests.append((top, left, h, w, extent))
+    return sub_requests
+
+def get_large_area(bbox:BoundingBox, year:str, path:str=None, max_workers:int=MAX_WORKERS) -> np.ndarray:
+    """
+    Fetches an arbitrary bounding box from s2maps at 10m/pixel
+
+    Arguments:
+        bbox: area to fetch (BoundingBox)
+        year: year of historical data, 4 options among [2017,2018,2019,2020]
+        path: if given, the mosaic is a np.memmap stored in this file instead of living in memory
+        max_workers: number of WMS sub-requests running at the same time
+
+    Returns:
+        A (height, width, 3) uint8 array, height and width being multiples of 64
+    """
+    height, width = area_pixels(bbox)
+    if path is None:
+        mosaic = np.zeros((height, width, 3), dtype='uint8')
+    else:
+        mosaic = np.lib.format.open_memmap(path, mode='w+', dtype='uint8', shape=(height, width, 3))
+
+    def fetch(sub_request):
+        top, left, h, w, extent = sub_request
+        content = get_s2maps_bytes(f"s2cloudless-{year}", extent, w, h)
+        mosaic[top:top+h, left:left+w] = np.asarray(Image.open(BytesIO(content)).convert('RGB'))
+
+    # only the sub-requests in flight are decoded at the same time
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(fetch, sub_request) for sub_request in split_area(bbox)]
+        for future in as_completed(futures):
+            future.result()
+
+    if path is not None:
+        mosaic.flush()
+    return mosaic
+
+def iter_tile_batches(mosaic:np.ndarray, batch_tiles:int=BATCH_TILES, tile_size:int=64):
+    '''
+    Yields (start, tiles) where tiles is a (n, tile_size, tile_size, 3) array holding the tiles
+    start to start+n of the mosaic, ordered row by row. Only one batch is copied in memory at a time
+    '''
+    view = tile_view(mosaic, tile_size)
+    rows, cols = view.shape[:2]
+    for start in range(0, rows * cols, batch_tiles):
+        indices = np.arange(start, min(start + batch_tiles, rows * cols))
+        yield start, view[indices // cols, indices % cols]
+
+def classify_large_area(mosaic:np.ndarray, predict, batch_tiles:int=BATCH_TILES) -> np.ndarray:
+    '''
+    Classifies every 64x64 tile of the mosaic by batches.
+    predict receives a (n, 64, 64, 3) array and returns the n predicted classes.
+    Returns a (rows, cols) uint8 array of classes
+    '''
+    rows, cols = mosaic.shape[0] // 64, mosaic.shape[1] // 64
+    classes = np.empty(rows * cols, dtype='uint8')
+    for start, tiles in iter_tile_batches(mosaic, batch_tiles):
+        classes[start:start + len(tiles)] = predict(tiles)
+    return classes.reshape((rows, cols))
@@ -0,0 +1,107 @@
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque
+from contextlib import contextmanager
+
+#################################################
+#                    METRICS                    #
+#################################################
+
+# If set, every traced call is appended to this file as a JSON line
+METRICS_LOG = os.environ.get('WFA_METRICS_LOG')
+# Number of traced calls kept in memory for the debug panel
+RECENT_EVENTS = 200
+
+class Metrics(object):
+    """
+    Thread safe aggregation of the traced calls, per stage: number of calls, errors,
+    total and maximum duration, bytes transferred, cache hits and misses
+    """
+    def __init__(self, log_path:str=METRICS_LOG):
+        self.stages = {}
+        self.recent = deque(maxlen=RECENT_EVENTS)
+        self.log_path = log_path
+        self._lock = threading.Lock()
+
+    def record(self, stage:str, seconds:float, nbytes:int=0, cache_hit:bool=None, error:bool=False):
+        event = dict(time=time.time(), stage=stage, seconds=seconds, bytes=nbytes, cache_hit=cache_hit, error=error)
+        with self._lock:
+            stats = self.stages.setdefault(stage, dict(count=0, errors=0, seconds=0.0, max_seconds=0.0,
+                                                        bytes=0, cache_hits=0, cache_misses=0))
+            stats['count'] += 1
+            stats['errors'] += int(error)
+            stats['seconds'] += seconds
+            stats['max_seconds'] = max(stats['max_seconds'], seconds)
+            stats['bytes'] += nbytes
+            if cache_hit is not None:
+                stats['cache_hits' if cache_hit else 'cache_misses'] += 1
+            self.recent.append(event)
+            if self.log_path is not None:
+                with open(self.log_path, 'a') as f:
+                    f.write(json.dumps(event) + '\n')
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {stage: dict(stats) for stage, stats in self.stages.items()}
+
+    def to_prometheus(self) -> str:
+        '''
+        Exports the metrics in the Prometheus text format
+        '''
+        lines = []
+        metrics = [('wfa_stage_calls_total', 'count', 'counter'),
+                   ('wfa_stage_errors_total', 'errors', 'counter'),
+                   ('wfa_stage_duration_seconds_sum', 'seconds', 'counter'),
+                   ('wfa_stage_duration_seconds_max', 'max_seconds', 'gauge'),
+                   ('wfa_stage_bytes_total', 'bytes', 'counter'),
+                   ('wfa_stage_cache_hits_total', 'cache_hits', 'counter'),
+                   ('wfa_stage_cache_misses_total', 'cache_misses', 'counter')]
+        snapshot = self.snapshot()
+        for name, field, kind in metrics:
+            lines.append(f"# TYPE {name} {kind}")
+            for stage, stats in sorted(snapshot.items()):
+                lines.append(f'{name}{{stage="{stage}"}} {stats[field]}')
+        return '\n'.join(lines) + '\n'
+
+    def reset(self):
+        with self._lock:
+            self.stages.clear()
+            self.recent.clear()
+
+metrics = Metrics()
+
+@contextmanager
+def trace(stage:str):
+    '''
+    Times the block and records it under 'stage'. The block can fill the yielded dict
+    with 'bytes' and 'cache_hit'
+
+        with trace('download_tile') as span:
+            span['bytes'] = len(content)
+    '''
+    span = dict(bytes=0, cache_hit=None)
+    start = time.perf_counter()
+    error = False
+    try:
+        yield span
+    except Exception:
+        error = True
+        raise
+    finally:
+        metrics.record(stage, time.perf_counter() - start, span['bytes'], span['cache_hit'], error)
+
+def timed(stage:str=None):
+    '''
+    Decorator tracing every call of the function, under its name by default
+    '''
+    def decorator(func):
+        name = stage or func.__name__
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with trace(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,56 @@
+#################################################
+#                   PLOTTING                    #
+#################################################
+
+# matplotlib is slow to import and only needed in notebooks, it is imported on first use
+
+def _pyplot():
+    import matplotlib.pyplot as plt
+    return plt
+
+def plot_image_categories(img, classes):
+    '''
+    Plot the image with the quadrants and correspondent classes
+    '''
+    xs = range(64, img.height, 64)
+    xt = range(20, img.height, 64)
+    yt = range(44, img.height, 64)
+    plt = _pyplot()
+    plt.imshow(img)
+    # multiple lines all full height
+    plt.vlines(x=xs, ymin=0, ymax=img.height-1, colors='red', ls='-', lw=0.5)
+    plt.hlines(y=xs, xmin=0, xmax=img.height-1, colors='red', ls='-', lw=0.5)
+    for item_y,value_y in enumerate(yt):
+        for item_x,value_x in enumerate(xt):
+            plt.text(value_x, value_y, classes[item_y, item_x], color = 'red')
+    plt.show()
+
+def plot_sub_images_categories(img, classes):
+    '''
+    Plot a grid of tiles contained in X_new (PIL) with its correspondent predicted classes
+    '''
+    plt = _pyplot()
+    quads = int(img.height/64)
+    fig, axs = plt.subplots(quads, quads, figsize = (10, 10))
+    for i in range(quads):
+        for j in range(quads):
+            img_quad = img.crop((i*64, j*64, i*64+64, j*64+64))
+            axs[j, i].imshow(img_quad)
+            axs[j, i].text(22, 40, classes[j, i], color = 'red')
+            axs[j, i].axis('off')
+    plt.show()
+
+def plot_classified_images(X_new, y_pred_class):
+    """
+    Plot a grid of tiles contained in X_new (np.array) with its correspondent predicted classes
+    """
+    plt = _pyplot()
+    size = int(X_new.shape[0] ** 0.5)
+    X_reshaped = X_new.reshape((size,size,64,64,3))
+    fig, axs = plt.subplots(size, size, figsize = (10, 10))
+    for i in range(size) :
+        for j in range(size) :
+            axs[j, i].imshow(X_reshaped[i,j])
+            axs[j, i].text(22, 40, y_pred_class[j, i], color = 'red')
+            axs[j, i].axis('off')
+    plt.show()
@@ -0,0 +1,221 @@
+import os
+import json
+import threading
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+import http_client
+from cache import get_cache
+from metrics import trace, timed
+from get_new_images import split_tiles
+
+#################################################
+#              PREDICTION BACKENDS              #
+#################################################
+
+WFA_API_URL = 'https://wfa04-tqv5zy4gla-ew.a.run.app/watchingfromabove/prediction'
+# Seconds to wait for the prediction API (Cloud Run cold starts are slow)
+API_TIMEOUT = (3.05, 120)
+# Number of tiles classified at once by the local backend
+BATCH_SIZE = 256
+# Incremental mode: tiles whose mean absolute pixel difference between the two years (0-255)
+# is below this threshold keep the class of year 1 instead of being classified again.
+# Disabled when not set
+CHANGE_THRESHOLD = os.environ.get('WFA_CHANGE_THRESHOLD')
+
+def tile_differences(tiles_1:np.ndarray, tiles_2:np.ndarray) -> np.ndarray:
+    '''
+    Receives two (rows, cols, 64, 64, 3) arrays of tiles and returns the (rows, cols) mean absolute
+    difference of their pixels. The mean color of each year is removed first, so that a global change
+    of brightness between the two mosaics does not count as a change
+    '''
+    offset = tiles_1.mean(axis=(0, 1, 2, 3)) - tiles_2.mean(axis=(0, 1, 2, 3))
+    diff = tiles_1.astype('float32') - tiles_2 - offset.astype('float32')
+    return np.abs(diff).mean(axis=(2, 3, 4))
+
+class PredictionBackend(object):
+    """
+    Classifies the 64x64 tiles of the images of two years.
+
+    Backends with uses_images = True classify the images fetched by the caller,
+    the others (remote API) only need the coordinates and years.
+    When change_threshold is set, only the tiles that changed are classified for year 2.
+    """
+    uses_images = True
+    change_threshold = None
+
+    @property
+    def identity(self) -> str:
+        '''
+        Identifies the model behind the backend, results of different models must not be mixed
+        '''
+        return type(self).__name__
+
+    def classify(self, tiles:np.ndarray) -> np.ndarray:
+        '''
+        Receives a (N, 64, 64, 3) uint8 array and returns the N predicted classes
+        '''
+        raise NotImplementedError
+
+    def classify_image(self, image) -> np.ndarray:
+        '''
+        Returns the (rows, cols) grid of classes of an image (PIL)
+        '''
+        tiles = split_tiles(image, flat=False)
+        rows, cols = tiles.shape[:2]
+        classes = self.classify(tiles.reshape((-1,) + tiles.shape[2:]))
+        return np.asarray(classes, dtype='uint8').reshape((rows, cols))
+
+    def predict(self, lat:float, lon:float, year_1:str, year_2:str, image_year_1=None, image_year_2=None) -> tuple:
+        '''
+        Returns the grids of classes of both years
+        '''
+        if self.change_threshold is not None:
+            return self.predict_changes(image_year_1, image_year_2, self.change_threshold)
+        return self.classify_image(image_year_1), self.classify_image(image_year_2)
+
+    def predict_changes(self, image_year_1, image_year_2, threshold:float) -> tuple:
+        '''
+        Classifies every tile of year 1 and only the tiles of year 2 that differ from year 1
+        by at least 'threshold' (see tile_differences), the others keep the class of year 1
+        '''
+        tiles_1 = split_tiles(image_year_1, flat=False)
+        tiles_2 = split_tiles(image_year_2, flat=False)
+        if tiles_1.shape != tiles_2.shape:
+            return self.classify_image(image_year_1), self.classify_image(image_year_2)
+
+        rows, cols = tiles_1.shape[:2]
+        classes_1 = np.asarray(self.classify(tiles_1.reshape((-1,) + tiles_1.shape[2:])), dtype='uint8').reshape((rows, cols))
+        changed = tile_differences(tiles_1, tiles_2) >= threshold
+        classes_2 = classes_1.copy()
+        if changed.any():
+            classes_2[changed] = self.classify(tiles_2[changed])
+        return classes_1, classes_2
+
+    def predict_years(self, lat:float, lon:float, years:list, images:list=None) -> np.ndarray:
+        '''
+        Returns the (years, rows, cols) stack of classes of all the years,
+        the tiles of every year are classified together
+        '''
+        tiles = np.stack([split_tiles(image, flat=False) for image in images])
+        n_years, rows, cols = tiles.shape[:3]
+        classes = self.classify(tiles.reshape((-1,) + tiles.shape[3:]))
+        return np.asarray(classes, dtype='uint8').reshape((n_years, rows, cols))
+
+class RemoteBackend(PredictionBackend):
+    """
+    Calls the Cloud Run prediction API, which fetches the images by itself.
+    Answers are kept in the disk cache, and served even expired when the API is down
+    """
+    uses_images = False
+
+    def __init__(self, url:str=WFA_API_URL):
+        self.url = url
+
+    @property
+    def identity(self) -> str:
+        return f"remote {self.url}"
+
+    def predict(self, lat:float, lon:float, year_1:str, year_2:str, image_year_1=None, image_year_2=None) -> tuple:
+        params = dict(
+            address = f"{lat}, {lon}",
+            year_1 = year_1,
+            year_2 = year_2)
+        with trace('prediction_api') as span:
+            cache = get_cache()
+            key = cache.key('prediction', self.url, *[f"{value:.5f}" for value in (lat, lon)], year_1, year_2)
+            content = cache.get_or_fetch(key, lambda: http_client.get(self.url, params=params, timeout=API_TIMEOUT, retry_reads=False).content, span)
+            results = json.loads(content)
+        return np.array(results['year_1'], dtype='uint8'), np.array(results['year_2'], dtype='uint8')
+
+    def predict_years(self, lat:float, lon:float, years:list, images:list=None) -> np.ndarray:
+        '''
+        The API compares two years per call, the years are sent by pairs in parallel
+        '''
+        pairs = [(years[i], years[min(i + 1, len(years) - 1)]) for i in range(0, len(years), 2)]
+        with ThreadPoolExecutor(max_workers=len(pairs)) as executor:
+            results = list(executor.map(lambda pair: self.predict(lat, lon, *pair), pairs))
+        classes = [grid for result in results for grid in result]
+        return np.stack(classes[:len(years)])
+
+class LocalBackend(PredictionBackend):
+    """
+    Classifies the tiles in-process by batches of batch_size.
+
+    The model is either an ONNX file (onnxruntime is then required) or any object
+    with a predict method returning the probabilities of the 10 classes (e.g. keras).
+    It is loaded once and kept in memory. A backend loaded from model_path can be sent to
+    other processes, which load the model again.
+    """
+    def __init__(self, model_path:str=None, model=None, batch_size:int=BATCH_SIZE, scale:float=1/255):
+        self.model_path = model_path if model is None else None
+        self.batch_size = batch_size
+        self.scale = scale
+        self._lock = threading.Lock()
+        if model is not None:
+            self._predict = model.predict
+        elif model_path is not None and model_path.endswith('.onnx'):
+            import onnxruntime
+            session = onnxruntime.InferenceSession(model_path)
+            input_name = session.get_inputs()[0].name
+            self._predict = lambda batch: session.run(None, {input_name: batch})[0]
+        else:
+            raise ValueError(f"Unsupported model: {model_path}")
+
+    @property
+    def identity(self) -> str:
+        return f"local {self.model_path}"
+
+    def __getstate__(self):
+        if self.model_path is None:
+            raise TypeError('Only a LocalBackend loaded from model_path can be pickled')
+        return dict(model_path=self.model_path, batch_size=self.batch_size, scale=self.scale,
+                    change_threshold=self.change_threshold)
+
+    def __setstate__(self, state):
+        self.__init__(state['model_path'], batch_size=state['batch_size'], scale=state['scale'])
+        self.change_threshold = state['change_threshold']
+
+    @timed('local_classify')
+    def classify(self, tiles:np.ndarray) -> np.ndarray:
+        classes = np.empty(len(tiles), dtype='uint8')
+        for start in range(0, len(tiles), self.batch_size):
+            batch = tiles[start:start + self.batch_size].astype('float32') * self.scale
+            with self._lock:
+                probabilities = self._predict(batch)
+            classes[start:start + len(batch)] = np.argmax(probabilities, axis=1)
+        return classes
+
+class StubBackend(PredictionBackend):
+    """
+    Offline backend for tests: the class only depends on the dominant color of the tile,
+    Forest when green, SeaLake when blue and AnnualCrop otherwise
+    """
+    def classify(self, tiles:np.ndarray) -> np.ndarray:
+        means = tiles.reshape((len(tiles), -1, 3)).mean(axis=1)
+        dominant = np.argmax(means, axis=1)
+        return np.array([0, 1, 9], dtype='uint8')[dominant]
+
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend() -> PredictionBackend:
+    '''
+    Returns the backend selected by the WFA_BACKEND environment variable ('remote' by default,
+    'local' with WFA_MODEL_PATH, or 'stub'), created once per process.
+    WFA_CHANGE_THRESHOLD enables the incremental mode of the backends classifying images
+    '''
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            name = os.environ.get('WFA_BACKEND', 'remote')
+            if name == 'local':
+                _backend = LocalBackend(os.environ.get('WFA_MODEL_PATH'))
+            elif name == 'stub':
+                _backend = StubBackend()
+            elif name == 'remote':
+                _backend = RemoteBackend(os.environ.get('WFA_API_URL', WFA_API_URL))
+            else:
+                raise ValueError(f"Unknown prediction backend: {name}")
+            if CHANGE_THRESHOLD is not None and _backend.uses_images:
+                _backend.change_threshold = float(CHANGE_THRESHOLD)
+    return _backend
@@ -0,0 +1,236 @@
+import io
+import json
+import asyncio
+import argparse
+import requests
+import numpy as np
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from geocoding import geocode
+from get_new_images import get_image
+from comparison import result_key, compute_comparison, rendered_comparison, ResultsCache
+from image_viz import CLASSES
+from prediction import get_backend
+from storage import IMAGE_FORMAT
+from metrics import metrics
+
+#################################################
+#                  ASYNC SERVER                 #
+#################################################
+
+# Threads running the blocking pipeline (downloads, predictions, rendering)
+SERVER_WORKERS = 16
+# Panels of a comparison that can be requested as images
+PANELS = ('image_year_1', 'image_year_2', 'changes_year_1', 'changes_year_2', 'colormap_year_1', 'colormap_year_2')
+
+class HTTPError(Exception):
+    """
+    Error answered to the client with the given status
+    """
+    def __init__(self, status:int, message:str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class Coalescer(object):
+    """
+    Runs blocking calls in an executor, simultaneous calls with the same key share one run
+    """
+    def __init__(self, executor):
+        self.executor = executor
+        self.inflight = {}
+        self.coalesced = 0
+
+    async def run(self, key, func, *args):
+        future = self.inflight.get(key)
+        if future is not None:
+            self.coalesced += 1
+        else:
+            future = asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self.inflight.pop(key, None))
+        # a client going away must not cancel the run shared with the others
+        return await asyncio.shield(future)
+
+class WFAServer(object):
+    """
+    ASGI application exposing the comparison pipeline, e.g. 'uvicorn server:app'
+
+        GET /geocode?address=...                          -> {"lat": ..., "lon": ...}
+        GET /imagery?address=...&year=2018                -> JPEG image (year can be 'Google')
+        GET /comparison?address=...&year_1=..&year_2=..   -> classes, changes and summary as JSON
+        GET /summary?address=...&year_1=..&year_2=..      -> summary table as JSON
+        GET /panel?address=...&year_1=..&year_2=..&name=  -> one of PANELS as a PNG image
+        GET /rendered?address=...&year_1=..&year_2=..     -> all the panels in one WebP (or JPEG) image
+        GET /metrics                                      -> Prometheus metrics
+
+    'lat' and 'lon' can be given instead of 'address'.
+    """
+    def __init__(self, backend=None, results:ResultsCache=None, max_workers:int=SERVER_WORKERS):
+        self.backend = backend or get_backend()
+        self.results = results if results is not None else ResultsCache()
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.coalescer = Coalescer(self.executor)
+        self.routes = {
+            '/geocode': self.geocode,
+            '/imagery': self.imagery,
+            '/comparison': self.comparison,
+            '/summary': self.summary,
+            '/panel': self.panel,
+            '/rendered': self.rendered,
+            '/metrics': self.metrics,
+            '/health': self.health}
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        query = {key: values[0] for key, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+        try:
+            route = self.routes.get(scope['path'])
+            if route is None:
+                raise HTTPError(404, f"Unknown path {scope['path']}")
+            if scope['method'] != 'GET':
+                raise HTTPError(405, 'Only GET is supported')
+            status, content_type, body = await route(query)
+        except HTTPError as e:
+            status, content_type, body = e.status, 'application/json', json.dumps(dict(error=e.message)).encode()
+        except requests.RequestException as e:
+            status, content_type, body = 502, 'application/json', json.dumps(dict(error=f"Upstream unavailable ({e})")).encode()
+
+        await send({'type': 'http.response.start',
+                    'status': status,
+                    'headers': [(b'content-type', content_type.encode()),
+                                (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    #################################################
+    #                   PIPELINE                    #
+    #################################################
+
+    async def locate(self, query:dict) -> tuple:
+        '''
+        Coordinates of the request, from 'lat' and 'lon' or by geocoding 'address'
+        '''
+        if 'lat' in query and 'lon' in query:
+            try:
+                lat, lon = float(query['lat']), float(query['lon'])
+            except ValueError:
+                raise HTTPError(400, 'lat and lon must be numbers')
+            if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+                raise HTTPError(400, 'lat must be between -90 and 90 and lon between -180 and 180')
+            return lat, lon
+        if 'address' not in query:
+            raise HTTPError(400, "Missing 'address' or 'lat' and 'lon'")
+        try:
+            return await self.coalescer.run(('geocode', query['address']), geocode, query['address'])
+        except ValueError as e:
+            raise HTTPError(404, str(e))
+
+    async def get_comparison(self, query:dict) -> tuple:
+        '''
+        Returns the years and the cached or computed comparison of the request
+        '''
+        lat, lon = await self.locate(query)
+        year_1 = query.get('year_1', '2018')
+        year_2 = query.get('year_2', '2020')
+        key = result_key(lat, lon, year_1, year_2)
+
+        result = self.results.get(key)
+        if result is None:
+            result = await self.coalescer.run(('comparison',) + key, compute_comparison, lat, lon, year_1, year_2, self.backend)
+            self.results.set(key, result)
+        return year_1, year_2, result
+
+    #################################################
+    #                   ENDPOINTS                   #
+    #################################################
+
+    async def geocode(self, query:dict) -> tuple:
+        lat, lon = await self.locate(query)
+        return json_response(dict(lat=lat, lon=lon))
+
+    async def imagery(self, query:dict) -> tuple:
+        lat, lon = await self.locate(query)
+        year = query.get('year', '2020')
+        key = ('image',) + result_key(lat, lon, year)
+        image = await self.coalescer.run(key, get_image, lat, lon, year)
+        # encoding blocks for several milliseconds, not on the event loop
+        return await self.coalescer.run(('jpeg',) + key, image_response, image, 'JPEG')
+
+    async def comparison(self, query:dict) -> tuple:
+        year_1, year_2, result = await self.get_comparison(query)
+        cat_year_1_np, cat_year_2_np = result['predictions']
+        return json_response(dict(year_1=year_1,
+                                  year_2=year_2,
+                                  classes=CLASSES.tolist(),
+                                  classes_year_1=np.asarray(cat_year_1_np).tolist(),
+                                  classes_year_2=np.asarray(cat_year_2_np).tolist(),
+                                  changes=np.asarray(result['changes']).astype('uint8').tolist(),
+                                  summary=summary_records(result['summary'])))
+
+    async def summary(self, query:dict) -> tuple:
+        year_1, year_2, result = await self.get_comparison(query)
+        return json_response(dict(year_1=year_1, year_2=year_2, summary=summary_records(result['summary'])))
+
+    async def panel(self, query:dict) -> tuple:
+        name = query.get('name')
+        if name not in PANELS:
+            raise HTTPError(400, f"'name' must be one of {', '.join(PANELS)}")
+        _, _, result = await self.get_comparison(query)
+        return await asyncio.get_running_loop().run_in_executor(self.executor, image_response, result[name], 'PNG')
+
+    async def rendered(self, query:dict) -> tuple:
+        year_1, year_2, result = await self.get_comparison(query)
+        if 'rendered' not in result:
+            key = result_key(*await self.locate(query), year_1, year_2)
+            await self.coalescer.run(('rendered',) + key, rendered_comparison, result)
+            # stored again so that the cache counts the rendered bytes
+            self.results.set(key, result)
+        return 200, f"image/{IMAGE_FORMAT.lower()}", result['rendered']
+
+    async def metrics(self, query:dict) -> tuple:
+        return 200, 'text/plain; version=0.0.4', metrics.to_prometheus().encode()
+
+    async def health(self, query:dict) -> tuple:
+        return json_response(dict(status='ok', inflight=len(self.coalescer.inflight),
+                                  coalesced=self.coalescer.coalesced, results=len(self.results)))
+
+def summary_records(summary) -> list:
+    '''
+    Rows of the summary DataFrame (see image_viz.summary) with their cat_ID
+    '''
+    records = summary.reset_index().to_dict(orient='records')
+    return [dict(record, cat_ID=int(record['cat_ID'])) for record in records]
+
+def json_response(content:dict) -> tuple:
+    return 200, 'application/json', json.dumps(content).encode()
+
+def image_response(image, img_format:str) -> tuple:
+    output = io.BytesIO()
+    image.convert('RGB').save(output, format=img_format)
+    return 200, f"image/{img_format.lower()}", output.getvalue()
+
+app = WFAServer()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serves the WFA comparison pipeline over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+
+    # any ASGI server works, uvicorn is only needed to run this module directly
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,272 @@
+import os
+import json
+import math
+import time
+import hashlib
+import threading
+import numpy as np
+from PIL import Image
+from storage import IMAGE_FORMAT, IMAGE_QUALITY, site_id
+from get_new_images import get_bounding_box, S2MAPS_YEARS
+
+#################################################
+#                 SPATIAL INDEX                 #
+#################################################
+
+# Folder of the index. Not inside the disk cache folder, whose eviction would delete the archive
+INDEX_DIR = os.environ.get('WFA_INDEX_DIR', '.wfa_index')
+INDEX_MAX_BYTES = int(os.environ.get('WFA_INDEX_MAX_BYTES', 200 * 1024 * 1024))
+# Geohash cells of about 5 x 5 km at the equator
+GEOHASH_PRECISION = 5
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+TILE_SIZE = 64
+SIZE_KM = 6.4
+
+def geohash(lat:float, lon:float, precision:int=GEOHASH_PRECISION) -> str:
+    '''
+    Geohash of a point, bits alternate between longitude and latitude starting with longitude
+    '''
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    while len(chars) < precision:
+        interval, coord = (lon_range, lon) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        value <<= 1
+        if coord >= middle:
+            value |= 1
+            interval[0] = middle
+        else:
+            interval[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars)
+
+def geohash_cell(precision:int=GEOHASH_PRECISION) -> tuple:
+    '''
+    Size (lat, lon) in degrees of the geohash cells of the given precision
+    '''
+    lon_bits = (5 * precision + 1) // 2
+    lat_bits = 5 * precision // 2
+    return 180.0 / 2 ** lat_bits, 360.0 / 2 ** lon_bits
+
+def covering_cells(lat_min:float, lon_min:float, lat_max:float, lon_max:float,
+                   precision:int=GEOHASH_PRECISION) -> set:
+    '''
+    Geohashes of all the cells intersecting the box
+    '''
+    lat_step, lon_step = geohash_cell(precision)
+    lats = [lat_min + i * lat_step for i in range(int((lat_max - lat_min) / lat_step) + 1)] + [lat_max]
+    lons = [lon_min + i * lon_step for i in range(int((lon_max - lon_min) / lon_step) + 1)] + [lon_max]
+    return {geohash(lat, lon, precision) for lat in lats for lon in lons}
+
+class SpatialIndex(object):
+    """
+    Persistent index of the footprints already analyzed, each one stored as an image and
+    a .npy grid of classes in the 'footprints' folder.
+
+    Each footprint is registered in every geohash cell it intersects. A query is answered
+    tile by tile: every 64 pixel tile of its box is copied from the tile of a footprint of
+    the same year containing its center, i.e. shifted by at most half a tile, so a query
+    can be assembled from several neighbouring footprints. Once 'max_bytes' is exceeded,
+    the least recently used footprints are removed, like in DiskCache.
+    """
+    def __init__(self, directory:str=INDEX_DIR, precision:int=GEOHASH_PRECISION, max_bytes:int=INDEX_MAX_BYTES):
+        self.directory = directory
+        self.precision = precision
+        self.max_bytes = max_bytes
+        self.records = {}
+        self.buckets = {}
+        self._size = 0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(directory, 'footprints'), exist_ok=True)
+
+        self.path = os.path.join(directory, 'footprints.jsonl')
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        # footprints evicted or written by an older version are skipped
+                        if 'name' in record and all(os.path.exists(path) for path in self._paths(record)):
+                            self._register(record)
+
+    def _paths(self, record:dict) -> tuple:
+        extension = 'webp' if IMAGE_FORMAT == 'WEBP' else 'jpg'
+        base = os.path.join(self.directory, 'footprints', record['name'])
+        return f"{base}.npy", f"{base}.{extension}"
+
+    def _register(self, record:dict):
+        self.records[record['name']] = record
+        self._size += record['bytes']
+        cells = covering_cells(record['lat_min'], record['lon_min'], record['lat_max'], record['lon_max'], self.precision)
+        for cell in cells:
+            self.buckets.setdefault(cell, []).append(record)
+
+    def _unregister(self, record:dict):
+        if self.records.pop(record['name'], None) is None:
+            return
+        self._size -= record['bytes']
+        for cell, records in self.buckets.items():
+            self.buckets[cell] = [other for other in records if other is not record]
+        for path in self._paths(record):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _forget(self, record:dict):
+        with self._lock:
+            self._unregister(record)
+
+    def find(self, lat:float, lon:float, year:str, size_km:float=SIZE_KM, backend:str=None):
+        '''
+        Returns (rows, cols, sources) if the footprints of the same year and backend (see
+        PredictionBackend.identity) cover the query box, None otherwise. sources lists, row by
+        row, the (record, row, col) of the footprint tile used for each tile of the query
+        '''
+        box = get_bounding_box(lat, lon, size_km/2)
+        with self._lock:
+            candidates = {id(record): record
+                          for cell in covering_cells(box.lat_min, box.lon_min, box.lat_max, box.lon_max, self.precision)
+                          for record in self.buckets.get(cell, [])
+                          if record['year'] == str(year) and record.get('backend') == backend}
+        if not candidates:
+            return None
+
+        # the footprints closest to the query first, so that a single one is used when it covers everything
+        candidates = sorted(candidates.values(), key=lambda record: (
+            abs((record['lat_min'] + record['lat_max']) / 2 - lat) + abs((record['lon_min'] + record['lon_max']) / 2 - lon)))
+        tile_lat = (candidates[0]['lat_max'] - candidates[0]['lat_min']) / candidates[0]['rows']
+        tile_lon = (candidates[0]['lon_max'] - candidates[0]['lon_min']) / candidates[0]['cols']
+        rows = round((box.lat_max - box.lat_min) / tile_lat)
+        cols = round((box.lon_max - box.lon_min) / tile_lon)
+
+        sources = []
+        for row in range(rows):
+            for col in range(cols):
+                center_lat = box.lat_max - (row + 0.5) * tile_lat
+                center_lon = box.lon_min + (col + 0.5) * tile_lon
+                for record in candidates:
+                    record_row = math.floor((record['lat_max'] - center_lat) / (record['lat_max'] - record['lat_min']) * record['rows'])
+                    record_col = math.floor((center_lon - record['lon_min']) / (record['lon_max'] - record['lon_min']) * record['cols'])
+                    if 0 <= record_row < record['rows'] and 0 <= record_col < record['cols']:
+                        sources.append((record, record_row, record_col))
+                        break
+                else:
+                    return None
+        return rows, cols, sources
+
+    def crop(self, lat:float, lon:float, year:str, size_km:float=SIZE_KM, backend:str=None):
+        '''
+        Returns the (image, classes) of the query assembled from the footprints covering it, or None
+        '''
+        found = self.find(lat, lon, year, size_km, backend)
+        if found is None:
+            return None
+        rows, cols, sources = found
+
+        loaded = {}
+        for record, _, _ in sources:
+            if record['name'] in loaded:
+                continue
+            classes_path, image_path = self._paths(record)
+            try:
+                footprint_classes = np.load(classes_path)
+                footprint_image = Image.open(image_path)
+                footprint_image.load()
+                # access time used for the LRU eviction
+                for path in (classes_path, image_path):
+                    os.utime(path, (time.time(), os.stat(path).st_mtime))
+            except (OSError, ValueError):
+                # footprint removed or incomplete, the query is computed again and stored anew
+                self._forget(record)
+                return None
+            loaded[record['name']] = footprint_image.convert('RGB'), footprint_classes
+
+        classes = np.empty((rows, cols), dtype='uint8')
+        image = Image.new('RGB', (cols * TILE_SIZE, rows * TILE_SIZE))
+        for i, (record, record_row, record_col) in enumerate(sources):
+            row, col = divmod(i, cols)
+            footprint_image, footprint_classes = loaded[record['name']]
+            classes[row, col] = footprint_classes[record_row, record_col]
+            tile = footprint_image.crop((record_col * TILE_SIZE, record_row * TILE_SIZE,
+                                         (record_col + 1) * TILE_SIZE, (record_row + 1) * TILE_SIZE))
+            image.paste(tile, (col * TILE_SIZE, row * TILE_SIZE))
+        return image, classes
+
+    def add(self, lat:float, lon:float, year:str, image, classes, size_km:float=SIZE_KM, backend:str=None):
+        '''
+        Stores the image and classes of a query, unless its box is already covered
+        '''
+        if str(year) not in S2MAPS_YEARS or self.find(lat, lon, year, size_km, backend) is not None:
+            return
+
+        box = get_bounding_box(lat, lon, size_km/2)
+        name = f"{site_id(lat, lon).replace(',', '_')}_{year}"
+        if backend is not None:
+            # the same site can be stored once per backend
+            name += '_' + hashlib.sha1(backend.encode('utf-8')).hexdigest()[:8]
+        rows, cols = classes.shape
+        record = dict(name=name, year=str(year), backend=backend, rows=rows, cols=cols,
+                      lat_min=box.lat_min, lon_min=box.lon_min, lat_max=box.lat_max, lon_max=box.lon_max)
+
+        classes_path, image_path = self._paths(record)
+        np.save(classes_path, np.ascontiguousarray(classes, dtype='uint8'))
+        image.convert('RGB').save(image_path, format=IMAGE_FORMAT, quality=IMAGE_QUALITY)
+        record['bytes'] = os.path.getsize(classes_path) + os.path.getsize(image_path)
+
+        with self._lock:
+            if name in self.records:
+                return
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self._register(record)
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        '''
+        Removes the least recently used footprints until the index is back under 90% of max_bytes,
+        then rewrites footprints.jsonl without them. Called with the lock held
+        '''
+        def last_access(record):
+            try:
+                return max(os.stat(path).st_atime for path in self._paths(record))
+            except FileNotFoundError:
+                return 0.0
+
+        target = self.max_bytes * 0.9
+        for record in sorted(self.records.values(), key=last_access):
+            if self._size <= target:
+                break
+            self._unregister(record)
+
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> dict:
+        return dict(footprints=len(self.records), size_bytes=self._size)
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index() -> SpatialIndex:
+    '''
+    Returns the SpatialIndex shared by the whole process
+    '''
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = SpatialIndex()
+    return _index
@@ -0,0 +1,130 @@
+import os
+import io
+import json
+import threading
+import numpy as np
+from PIL import Image, features
+
+#################################################
+#                RESULTS ARCHIVE                #
+#################################################
+
+# Format and quality of the archived images, JPEG when Pillow has no WebP support
+IMAGE_FORMAT = 'WEBP' if features.check('webp') else 'JPEG'
+IMAGE_QUALITY = 80
+
+def site_id(lat:float, lon:float) -> str:
+    '''
+    Identifier of a location in the archive, coordinates rounded to 5 decimals (about 1 meter)
+    '''
+    return f"{lat:.5f},{lon:.5f}"
+
+def pack_changes(changes:np.ndarray) -> bytes:
+    '''
+    Stores the changes mask with one bit per quadrand
+    '''
+    return np.packbits(np.asarray(changes).astype(bool).ravel()).tobytes()
+
+def unpack_changes(packed, shape:tuple) -> np.ndarray:
+    '''
+    Inverse of pack_changes, returns a uint8 array of 0 and 1
+    '''
+    bits = np.unpackbits(np.frombuffer(packed, dtype='uint8'), count=int(np.prod(shape)))
+    return bits.reshape(shape)
+
+class ResultArchive(object):
+    """
+    Append-only archive of predictions, in a folder containing:
+        classes.bin: uint8 class grids, one after the other
+        changes.bin: bit-packed changes masks, one after the other
+        images/: one WebP (or JPEG) file per site and year
+        index.jsonl: one line per record with its site, years, offset and shape
+
+    The .bin files are read through np.memmap, so opening an archive only loads the index.
+    """
+    def __init__(self, directory:str):
+        self.directory = directory
+        self.index = {}
+        self._lock = threading.Lock()
+        self._memmaps = {}
+        os.makedirs(os.path.join(directory, 'images'), exist_ok=True)
+
+        index_path = os.path.join(directory, 'index.jsonl')
+        if os.path.exists(index_path):
+            with open(index_path) as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.index[self._record_key(record)] = record
+
+    @staticmethod
+    def _record_key(record:dict) -> tuple:
+        return (record['kind'], record['site'], *record['years'])
+
+    def _append(self, kind:str, site:str, years:list, data:bytes, shape:tuple):
+        with self._lock:
+            path = os.path.join(self.directory, f"{kind}.bin")
+            with open(path, 'ab') as f:
+                offset = f.tell()
+                f.write(data)
+            record = dict(kind=kind, site=site, years=[str(year) for year in years],
+                          offset=offset, size=len(data), shape=list(shape))
+            with open(os.path.join(self.directory, 'index.jsonl'), 'a') as f:
+                f.write(json.dumps(record) + '\n')
+            self.index[self._record_key(record)] = record
+            self._memmaps.pop(kind, None)
+
+    def _read(self, kind:str, record:dict) -> np.ndarray:
+        with self._lock:
+            if kind not in self._memmaps:
+                path = os.path.join(self.directory, f"{kind}.bin")
+                self._memmaps[kind] = np.memmap(path, dtype='uint8', mode='r')
+            data = self._memmaps[kind]
+        return data[record['offset']:record['offset'] + record['size']]
+
+    def _record(self, kind:str, site:str, *years) -> dict:
+        record = self.index.get((kind, site, *[str(year) for year in years]))
+        if record is None:
+            raise KeyError(f"No {kind} for {site} {years}")
+        return record
+
+    def write_classes(self, site:str, year:str, classes:np.ndarray):
+        classes = np.ascontiguousarray(classes, dtype='uint8')
+        self._append('classes', site, [year], classes.tobytes(), classes.shape)
+
+    def read_classes(self, site:str, year:str) -> np.ndarray:
+        '''
+        Returns the (rows, cols) uint8 grid of classes, a read-only view of the memory mapped file
+        '''
+        record = self._record('classes', site, year)
+        return self._read('classes', record).reshape(record['shape'])
+
+    def write_changes(self, site:str, year_1:str, year_2:str, changes:np.ndarray):
+        self._append('changes', site, [year_1, year_2], pack_changes(changes), np.shape(changes))
+
+    def read_changes(self, site:str, year_1:str, year_2:str) -> np.ndarray:
+        record = self._record('changes', site, year_1, year_2)
+        return unpack_changes(self._read('changes', record), tuple(record['shape']))
+
+    def _image_path(self, site:str, year:str) -> str:
+        extension = 'webp' if IMAGE_FORMAT == 'WEBP' else 'jpg'
+        return os.path.join(self.directory, 'images', f"{site.replace(',', '_')}_{year}.{extension}")
+
+    def write_image(self, site:str, year:str, image:Image.Image, quality:int=IMAGE_QUALITY):
+        output = io.BytesIO()
+        image.convert('RGB').save(output, format=IMAGE_FORMAT, quality=quality)
+        with open(self._image_path(site, year), 'wb') as f:
+            f.write(output.getvalue())
+
+    def read_image(self, site:str, year:str) -> Image.Image:
+        return Image.open(self._image_path(site, year))
+
+    def sites(self) -> list:
+        return sorted({record['site'] for record in self.index.values()})
+
+    def years(self, site:str) -> list:
+        '''
+        Years with archived classes for the site
+        '''
+        return sorted(record['years'][0] for record in self.index.values()
+                      if record['kind'] == 'classes' and record['site'] == site)
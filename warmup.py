@@ -0,0 +1,100 @@
+import time
+import threading
+from itertools import combinations
+from geocoding import geocode
+from get_new_images import S2MAPS_YEARS
+from comparison import result_key, compute_comparison, rendered_comparison, ResultsCache
+from prediction import get_backend
+
+#################################################
+#                 CACHE WARM-UP                 #
+#################################################
+
+# Examples offered in the app, most users pick one of them
+PRESETS = ['-20.859100, -61.143501',  # Deforestation Paraguay 1
+           '70, -22.32',              # Greenland melting
+           'Sao paulo',
+           '-20.596496, -60.505891',  # Deforestation Paraguay 2
+           '-21.607402, -60.635624',  # Deforestation Paraguay 3
+           '-22.183099, -61.431191',  # Deforestation Paraguay 4
+           '29.9298757, 31.6514432',  # New Administrative Capital, Wedian - Egypt
+           '-24.319728, -50.447382'  # Pin forest in Brazil
+           ]
+# Seconds between two warm-ups, shorter than the TTL of the results cache
+WARMUP_INTERVAL = 12 * 3600
+# Years whose pairs are warmed up. 2017 only covers Europe and none of the presets is in Europe,
+# 3 pairs x 8 presets keep the warm-up at about 190 MB of the results cache
+WARMUP_YEARS = [year for year in S2MAPS_YEARS if year != '2017']
+
+class WarmupJob(object):
+    """
+    Computes the comparisons of every preset and year pair (older year first) in a background thread
+    and stores them in the results cache (images and geocoding also end up in the disk cache).
+    The job runs again every 'interval' seconds, None to run it only once
+    """
+    def __init__(self, results:ResultsCache=None, backend=None, presets:list=PRESETS,
+                 years:list=WARMUP_YEARS, interval:float=WARMUP_INTERVAL):
+        self.results = results if results is not None else ResultsCache()
+        self.backend = backend
+        self.presets = presets
+        self.year_pairs = list(combinations(years, 2))
+        self.interval = interval
+        self.total = len(presets) * len(self.year_pairs)
+        self.done = 0
+        self.errors = []
+        self.running = False
+        self.finished_at = None
+        self._thread = None
+
+    def run_once(self):
+        backend = self.backend or get_backend()
+        self.running = True
+        self.done = 0
+        self.errors = []
+        for address in self.presets:
+            for year_1, year_2 in self.year_pairs:
+                try:
+                    lat, lon = geocode(address)
+                    key = result_key(lat, lon, year_1, year_2)
+                    if key not in self.results:
+                        result = compute_comparison(lat, lon, year_1, year_2, backend)
+                        # rendered here, in the background, rather than on the first visit
+                        rendered_comparison(result)
+                        self.results.set(key, result)
+                except Exception as e:
+                    self.errors.append(f"{address} {year_1}-{year_2}: {e!r}")
+                self.done += 1
+        self.running = False
+        self.finished_at = time.time()
+
+    def _loop(self):
+        while True:
+            self.run_once()
+            if self.interval is None:
+                return
+            time.sleep(self.interval)
+
+    def start(self):
+        '''
+        Starts the background thread, does nothing if it is already running
+        '''
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+        return self
+
+    def status(self) -> dict:
+        return dict(done=self.done,
+                    total=self.total,
+                    progress=self.done / self.total if self.total else 1.0,
+                    running=self.running,
+                    errors=len(self.errors),
+                    finished_at=self.finished_at)
+
+if __name__ == '__main__':
+    # fills the disk caches (images, geocoding) shared by the app processes
+    job = WarmupJob(interval=None)
+    job.run_once()
+    print(job.status())
+    for error in job.errors:
+        print(error)